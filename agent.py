@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Hosts every input, motion sensor, output and supervised service of a device in one
+# process over one MQTT connection. The config file (JSON, or YAML when PyYAML is
+# installed) lists the devices, keys match the command-line options of the single scripts:
+#
+# {
+#   "thingName": "pi1",
+#   "inputs": [{"pin": 17, "topic": "home/door", "shadow_var": "door"}],
+#   "motion": [{"pin": 4, "topic": "home/motion", "session": 30}],
+#   "outputs": [{"pin": 22, "topic": "home/relay", "shadow_var": "relay"},
+#               {"pin": 23, "topic": "home/led", "pwm": true}],
+#   "services": [{"service": "vstream", "topic": "home/vstream"}],
+#   "batch": "home/commands",
+#   "rules": [{"when": {"input": 17, "event": "pressed"}, "then": {"output": 22, "command": "pulse/3"}},
+#             {"when": {"motion": 4}, "then": {"service": "vstream", "seconds": 60}}],
+#   "info": {"interval": 60, "resync": 10, "thresholds": {"cpuTemperature": 1}},
+#   "shadow_window": 0.2,
+#   "sampler": {"sample_rate": 100},
+#   "gpiod": {"chip": "/dev/gpiochip0"},
+#   "supervisor": "http://localhost:9001/RPC2",
+#   "events": "/run/slice/events.sock"
+# }
+
+import json
+import logging
+import threading
+import time
+import iot
+from iot import RateLimiter
+from inputPub import Input
+from motionPub import Motion
+from occupancy import Sessionizer
+from sampler import Sampler
+from gpiochip import EdgeCapture
+from outputSub import Output
+from publisher import Publisher
+from patterns import Sequencer
+from rules import Rules
+from vstreamSub import VStream
+from shadow import Coalescer, Mirror
+from scheduler import Scheduler
+import supervised
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def load_config(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError('PyYAML is required to read {}'.format(path))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def info(client, thing, config):
+    # imported here so devices without an info section don't need psutil
+    import pinfo
+    telemetry = pinfo.Telemetry(client, thing, dict(pinfo.DEFAULT_THRESHOLDS, **config.get('thresholds', {})),
+                                config.get('resync', 10))
+    while True:
+        time.sleep(config.get('interval', 60))
+        try:
+            telemetry.report()
+        except Exception as err:
+            logging.warning('{}'.format(err))
+
+
+if __name__ == "__main__":
+    # Read in command-line parameters
+    parser = iot.argument_parser(topic=False)
+    parser.add_argument("-f", "--config", action="store", dest="config", required=True,
+                        help="Device config file (JSON or YAML), its thingName overrides --thingName")
+    args = parser.parse_args()
+    iot.validate_args(parser, args)
+
+    # Configure logging
+    iot.start_logging(args)
+
+    config = load_config(args.config)
+    thing = config.get('thingName', args.thingName)
+
+    # Connect to AWS IoT
+    myAWSIoTMQTTClient = iot.connect_from_args(args)
+    gpiozero = iot.load('gpiozero')
+
+    # session reports and history replies are queued for their own thread, so the QoS 1 publishes
+    # of history requests don't wait for acks on the SDK callback thread that handles them
+    publisher = Publisher(myAWSIoTMQTTClient, connect=False).start()
+
+    # one coalescer merges the shadow updates of all inputs
+    shadow = Coalescer(myAWSIoTMQTTClient, config.get('shadow_window', 0.2))
+
+    # one scheduler for output patterns and motion sessions; service pulses expire on their own
+    # scheduler, as stopping a service is a blocking supervisord call that would delay the steps
+    scheduler = Scheduler()
+    service_scheduler = Scheduler()
+
+    devices = []  # keeps gpiozero devices referenced for the life of the process
+    targets = {}  # batch target (output or service topic) -> handler
+    outputs = {}  # pin -> output handler
+    desired = {}  # thing -> {shadow_var: output handler} driven by the desired shadow state
+    sequencer = Sequencer(scheduler)
+    for c in config.get('outputs', []):
+        output = gpiozero.PWMOutputDevice(c['pin']) if c.get('pwm') else gpiozero.DigitalOutputDevice(c['pin'])
+        handler = Output(output, c['topic'], c.get('on_time', 1), c.get('off_time', 1), c.get('default', 1), sequencer)
+        myAWSIoTMQTTClient.subscribe('{}/#'.format(c['topic']), 1, handler.subscriptionCallback)
+        devices.append(handler)
+        targets[c['topic']] = handler
+        outputs[c['pin']] = handler
+        if 'shadow_var' in c:
+            desired.setdefault(c.get('thing', thing), {})[c['shadow_var']] = handler.set
+
+    mirrors = [Mirror(myAWSIoTMQTTClient, name, keys, shadow) for name, keys in desired.items()]
+    for mirror in mirrors:
+        mirror.subscribe()
+    myAWSIoTMQTTClient.onOnline = lambda: [mirror.resync() for mirror in mirrors]
+
+    # one supervisord connection and one status call for all services
+    supervisor = supervised.Supervisor(config.get('supervisor', supervised.DEFAULT_PROXY))
+    services = []
+    services_by_name = {}
+    for c in config.get('services', []):
+        handler = VStream(myAWSIoTMQTTClient, supervised.Supervised(c['service'], supervisor=supervisor),
+                          c.get('thing', thing), c['topic'], service_scheduler)
+        myAWSIoTMQTTClient.subscribe('{}/#'.format(c['topic']), 1, handler.subscriptionCallback)
+        services.append(handler)
+        services_by_name[c['service']] = handler
+        targets[c['topic']] = handler
+
+    # <batch>/batch carries commands for many outputs and services in one message
+    if 'batch' in config:
+        batch = iot.Batch(myAWSIoTMQTTClient, config['batch'], targets)
+        myAWSIoTMQTTClient.subscribe(batch.topic, 1, batch.subscriptionCallback)
+
+    # rules run output and service commands of input and motion events locally
+    rules = Rules(config.get('rules', []), outputs, services_by_name)
+
+    # with a gpiod section inputs and motion sensors report kernel timestamped edges from one thread
+    capture = EdgeCapture(config['gpiod'].get('chip')) if 'gpiod' in config else None
+    for c in config.get('inputs', []):
+        if capture is not None:
+            inp = capture.button(c['pin'], pull_up=c.get('pull_up', True), bounce_time=c.get('bounce_time'))
+        else:
+            inp = gpiozero.Button(c['pin'], pull_up=c.get('pull_up', True), bounce_time=c.get('bounce_time'))
+        handler = Input(myAWSIoTMQTTClient, c.get('thing', thing), c['shadow_var'], c['topic'],
+                        c.get('low_topic'), c.get('high_value', 1), c.get('low_value', 0), shadow=shadow,
+                        limiter=RateLimiter(c['event_rate']) if c.get('event_rate') else None)
+        inp.when_pressed = rules.bind('input', c['pin'], 'pressed', handler.high)
+        inp.when_released = rules.bind('input', c['pin'], 'released', handler.low)
+        devices.append(inp)
+
+    # with a sampler section all motion sensors are sampled by one thread at its rate
+    sampler = Sampler(config['sampler'].get('sample_rate', 100)) if 'sampler' in config else None
+    for c in config.get('motion', []):
+        if capture is not None:
+            pir = capture.motion_sensor(c['pin'])
+        elif sampler is not None:
+            pir = sampler.add(c['pin'], queue_len=c.get('queue_len', 1), threshold=c.get('threshold', 0.5))
+        else:
+            pir = gpiozero.MotionSensor(c['pin'], queue_len=c.get('queue_len', 1),
+                                        sample_rate=c.get('sample_rate', 100), threshold=c.get('threshold', 0.5))
+        if c.get('session'):
+            handler = Sessionizer(publisher, c.get('thing', thing), c['topic'], c['session'],
+                                  c.get('summary', 0), c.get('history', 1024), scheduler)
+            myAWSIoTMQTTClient.subscribe(c.get('history_topic', '{}/history'.format(c['topic'])), 1,
+                                         handler.historyCallback)
+        else:
+            handler = Motion(myAWSIoTMQTTClient, c.get('thing', thing), c['topic'])
+        pir.when_motion = rules.bind('motion', c['pin'], 'motion', handler.motion)
+        pir.when_no_motion = rules.bind('motion', c['pin'], 'no_motion', handler.no_motion)
+        devices.append(pir)
+
+    if sampler is not None and sampler.channels:
+        sampler.start()
+    if capture is not None and capture.lines:
+        capture.start()
+
+    if 'info' in config:
+        threading.Thread(target=info, args=(myAWSIoTMQTTClient, thing, config['info']),
+                         daemon=True).start()
+    iot.start_metrics(args, myAWSIoTMQTTClient, thing)
+
+    if args.profile_startup:
+        iot.report_startup()
+
+    for handler in services:
+        handler.check()
+    if 'events' in config:
+        for event in supervised.state_events(config['events']):
+            for handler in services:
+                handler.event(event)
+    else:
+        while True:
+            time.sleep(config.get('poll', 20))
+            for handler in services:
+                handler.check()
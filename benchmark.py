@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Benchmarks the agents without a Pi or AWS: the handlers run against an in-process MQTT broker
+# (transport.FakeBroker), gpiozero MockFactory pins and a fake supervisord XML-RPC server.
+# Results are written as JSON so runs of different versions can be compared:
+#
+# python benchmark.py --count 2000 --output benchmark-$(git describe --always).json
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+from xmlrpc.server import SimpleXMLRPCServer
+
+import iot
+from inputPub import Input
+from outputSub import Output
+from vstreamSub import VStream
+import pinfo
+import sensors
+from scheduler import Scheduler
+from shadow import Coalescer
+import supervised
+import transport
+
+THING = 'bench'
+OUTPUT_COMMANDS = ['on', 'off', 'pulse/1']
+Benchmarks = ['input', 'output', 'vstream', 'pinfo']
+
+
+def percentiles(samples):
+    """Returns p50, p99 and max of samples in seconds, as milliseconds"""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {'p50_ms': samples[len(samples) // 2] * 1000,
+            'p99_ms': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000,
+            'max_ms': samples[-1] * 1000}
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Receiver:
+    """Records the arrival time of every message on a topic filter"""
+
+    def __init__(self, client, topic, handler=None):
+        self.handler = handler
+        self.arrivals = []
+        self._expected = None
+        self._done = threading.Event()
+        client.subscribe(topic, 1, self.callback)
+
+    def callback(self, client, userdata, message):
+        if self.handler is not None:
+            self.handler(client, userdata, message)
+        self.arrivals.append((time.perf_counter(), message.payload))
+        if self._expected is not None and len(self.arrivals) >= self._expected:
+            self._done.set()
+
+    def wait(self, count, timeout=30):
+        """Waits for count messages, returns False on timeout"""
+        self._expected = count
+        if len(self.arrivals) >= count:
+            return True
+        return self._done.wait(timeout)
+
+
+class FakeSupervisord:
+    """The supervisord XML-RPC methods used by supervised.Supervisor"""
+
+    def __init__(self, processes):
+        self.states = dict((process, 'STOPPED') for process in processes)
+        self.calls = 0
+
+    def getAllProcessInfo(self):
+        self.calls += 1
+        return [{'name': name, 'group': name, 'statename': state} for name, state in self.states.items()]
+
+    def startProcess(self, name):
+        self.calls += 1
+        self.states[name] = 'RUNNING'
+        return True
+
+    def stopProcess(self, name):
+        self.calls += 1
+        self.states[name] = 'STOPPED'
+        return True
+
+    def serve(self):
+        """Serves the methods on a local port from a background thread, returns the proxy url"""
+        server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False, allow_none=True)
+        for method in ('getAllProcessInfo', 'startProcess', 'stopProcess'):
+            server.register_function(getattr(self, method), 'supervisor.' + method)
+        threading.Thread(target=server.serve_forever, name='supervisord', daemon=True).start()
+        return 'http://127.0.0.1:{}/RPC2'.format(server.server_address[1])
+
+
+class Bench:
+    """Broker and client connections shared by the benchmarks"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='broker', daemon=True).start()
+        self.broker = transport.FakeBroker()
+        self.port = asyncio.run_coroutine_threadsafe(self.broker.start(), self.loop).result()
+        self._clients = []
+
+    def client(self, name):
+        client = transport.ThreadedClient('{}-{}'.format(THING, name))
+        client.configureEndpoint('127.0.0.1', self.port)
+        client.connect()
+        self._clients.append(client)
+        return client
+
+    def close(self):
+        for client in self._clients:
+            client.disconnect()
+        asyncio.run_coroutine_threadsafe(self.broker.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def commands(bench, name, receiver, topics, count):
+    """Publishes count commands cycling through topics, returns the command latencies and rate"""
+    client = bench.client(name)
+    sent = []
+    start = time.perf_counter()
+    for i in range(count):
+        sent.append(time.perf_counter())
+        client.publish(topics[i % len(topics)], str(i), 1)
+    delivered = receiver.wait(count)
+    elapsed = time.perf_counter() - start
+    latencies = [arrival - sent[int(payload)] for arrival, payload in receiver.arrivals]
+    return dict({'commands': count, 'handled': len(receiver.arrivals), 'complete': delivered,
+                 'commands_per_s': len(receiver.arrivals) / elapsed}, **percentiles(latencies))
+
+
+def input_storm(bench, count, window):
+    """Button edges on a mock pin through inputPub.Input, edge to event message at the broker"""
+    gpiozero = iot.load('gpiozero')
+    client = bench.client('input')
+    receiver = Receiver(bench.client('input-observer'), '{}/input'.format(THING))
+    shadow = Coalescer(client, window)
+    handler = Input(client, THING, 'button', '{}/input'.format(THING), shadow=shadow)
+    button = gpiozero.Button(17)
+    button.when_pressed = handler.high
+    button.when_released = handler.low
+    edges = []
+    start = time.perf_counter()
+    for i in range(count):
+        edges.append(time.perf_counter())
+        if i % 2 == 0:
+            button.pin.drive_low()
+        else:
+            button.pin.drive_high()
+    handled = time.perf_counter() - start
+    delivered = receiver.wait(count)
+    elapsed = time.perf_counter() - start
+    button.close()
+    shadow.flush_all()  # the last windows are still open, stats() counts their documents once sent
+    latencies = [arrival - edge for (arrival, _), edge in zip(receiver.arrivals, edges)]
+    return dict({'edges': count, 'delivered': len(receiver.arrivals), 'complete': delivered,
+                 'edges_per_s': count / handled, 'delivered_per_s': len(receiver.arrivals) / elapsed,
+                 'shadow': shadow.stats()}, **percentiles(latencies))
+
+
+def output_flood(bench, count):
+    """Commands to outputSub.Output driving a mock pin, publish to handler returned"""
+    gpiozero = iot.load('gpiozero')
+    output = gpiozero.DigitalOutputDevice(18)
+    handler = Output(output, '{}/output'.format(THING))
+    receiver = Receiver(bench.client('output'), '{}/output/#'.format(THING), handler.subscriptionCallback)
+    result = commands(bench, 'output-commands', receiver,
+                      ['{}/output/{}'.format(THING, command) for command in OUTPUT_COMMANDS], count)
+    output.close()
+    return result
+
+
+def vstream_pulse(bench, count, services):
+    """Pulse commands to vstreamSub.VStream services of a fake supervisord, publish to handler returned"""
+    processes = ['service{}'.format(i) for i in range(services)]
+    supervisord = FakeSupervisord(processes)
+    supervisor = supervised.Supervisor(supervisord.serve())
+    scheduler = Scheduler()
+    client = bench.client('vstream')
+    routers = {}
+    for process in processes:
+        handler = VStream(client, supervised.Supervised(process, supervisor=supervisor), THING,
+                          '{}/vstream/{}'.format(THING, process), scheduler)
+        routers[handler.topic] = handler
+
+    def dispatch(client, userdata, message):
+        routers[message.topic.rsplit('/', 2)[0]].subscriptionCallback(client, userdata, message)
+
+    receiver = Receiver(client, '{}/vstream/#'.format(THING), dispatch)
+    calls = supervisord.calls
+    result = commands(bench, 'vstream-commands', receiver,
+                      ['{}/vstream/{}/pulse/{}'.format(THING, process, 1 + i % 5)
+                       for i, process in enumerate(processes)], count)
+    result['services'] = services
+    result['scheduled'] = len(scheduler)
+    result['rpc_calls'] = supervisord.calls - calls
+    return result
+
+
+def pinfo_cost(count):
+    """Time to read every sensor and to collect the full pinfo properties"""
+    reader = sensors.Sensors()
+    result = {'sensors': {}}
+    for metric in sorted(sensors.PROVIDERS):
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            value = reader.read(metric)
+            samples.append(time.perf_counter() - start)
+        result['sensors'][metric] = dict({'available': value is not None}, **percentiles(samples))
+    try:
+        iot.load('psutil').cpu_percent(interval=None)
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            pinfo.get_properties(cpu_interval=None)
+            samples.append(time.perf_counter() - start)
+        result['properties'] = percentiles(samples)
+    except ImportError as err:
+        result['properties'] = {'skipped': str(err)}
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="Edges, commands or readings per benchmark", type=int, default=1000)
+    parser.add_argument("-b", "--benchmark", action="append", dest="benchmark",
+                        help="Benchmark to run, repeat for several: %s (default all)" % str(Benchmarks))
+    parser.add_argument("--shadow_window", help="Seconds input shadow updates are merged", type=float, default=0.2)
+    parser.add_argument("--services", help="Number of supervised services commanded", type=int, default=4)
+    parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout")
+    iot.add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        args.benchmark = Benchmarks
+    for name in args.benchmark:
+        if name not in Benchmarks:
+            parser.error("Unknown --benchmark %s. Must be one of %s" % (name, str(Benchmarks)))
+            exit(2)
+
+    # Configure logging
+    iot.start_logging(args, logging.ERROR)
+
+    try:
+        iot.load('gpiozero').Device.pin_factory = iot.load('gpiozero.pins.mock').MockFactory()
+    except ImportError:
+        pass  # the gpio benchmarks report the missing module
+
+    bench = Bench()
+    runs = {
+        'input': lambda: input_storm(bench, args.count, args.shadow_window),
+        'output': lambda: output_flood(bench, args.count),
+        'vstream': lambda: vstream_pulse(bench, args.count, args.services),
+        'pinfo': lambda: pinfo_cost(args.count),
+    }
+    results = {}
+    for name in args.benchmark:
+        try:
+            results[name] = runs[name]()
+        except ImportError as err:
+            results[name] = {'skipped': str(err)}
+    bench.close()
+
+    doc = json.dumps({'version': version(), 'python': platform.python_version(), 'machine': platform.machine(),
+                      'time': datetime.datetime.now().isoformat(), 'count': args.count, 'results': results,
+                      'metrics': iot.metrics.snapshot()}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(doc + '\n')
+    else:
+        print(doc)
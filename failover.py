@@ -0,0 +1,227 @@
+import functools
+import logging
+import random
+import socket
+import threading
+import time
+import iot
+
+PROBE_TIMEOUT = 2  # seconds, also the rtt of an endpoint that was never probed
+SWITCH_RATIO = 0.5  # switch to an endpoint probing at most this fraction of the active endpoint's score
+RTT_ALPHA = 0.3  # weight of a new sample in the rtt moving average
+
+
+def parse_endpoint(spec, port):
+    """Parses HOST[:PORT][=WEIGHT]"""
+    address, _, weight = spec.partition('=')
+    host, _, endpoint_port = address.partition(':')
+    return Endpoint(host, int(endpoint_port) if endpoint_port else port, float(weight) if weight else 1)
+
+
+class Endpoint:
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.rtt = None
+        self.healthy = True
+        iot.metrics.gauge('endpoint_rtt_seconds', fn=lambda: self.rtt or 0, endpoint=self.name)
+        iot.metrics.gauge('endpoint_healthy', fn=lambda: int(self.healthy), endpoint=self.name)
+
+    @property
+    def name(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def score(self):
+        """Lower is better: rtt divided by weight"""
+        return (self.rtt if self.rtt is not None else PROBE_TIMEOUT) / self.weight
+
+    def observe(self, seconds):
+        self.rtt = seconds if self.rtt is None else self.rtt + RTT_ALPHA * (seconds - self.rtt)
+
+    def probe(self, timeout=PROBE_TIMEOUT):
+        """Measures the TCP connect time, marks the endpoint unhealthy if it can't be reached"""
+        start = time.perf_counter()
+        try:
+            socket.create_connection((self.host, self.port), timeout).close()
+        except OSError:
+            self.healthy = False
+            return None
+        self.healthy = True
+        self.observe(time.perf_counter() - start)
+        return self.rtt
+
+
+class ConnectionManager:
+    """AWSIoTMQTTClient compatible client that keeps one connection to the best of several endpoints.
+
+    Endpoints are ranked by probed TCP connect time divided by their weight. When the connection
+    drops or fails, the next healthy endpoint is tried at once; only when a whole round fails does
+    the manager back off, with full jitter so a fleet doesn't reconnect in lockstep. A background
+    probe moves the connection when another endpoint gets much faster. Subscriptions are replayed
+    on every new connection.
+    """
+
+    def __init__(self, endpoints, factory, probe_interval=60, backoff=0.5, max_backoff=32):
+        self.endpoints = endpoints
+        self.factory = factory  # (host, port) -> configured client, not connected
+        self.probe_interval = probe_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.keep_alive = 30
+        self.client = None
+        self.active = None
+        self.onOnline = None
+        self.onOffline = None
+        self._subscriptions = []
+        self._lock = threading.RLock()
+        self._failing_over = threading.Lock()
+        self._stopped = threading.Event()
+        self._prober = None
+        self._logger = logging.getLogger(__name__)
+        iot.metrics.gauge('connection_state', fn=lambda: int(self.client is not None))
+
+    def ranked(self, exclude=None):
+        """Returns the endpoints to try in order, healthy ones first"""
+        candidates = [e for e in self.endpoints if e is not exclude]
+        return sorted(candidates, key=lambda e: (not e.healthy, e.score()))
+
+    def probe(self):
+        threads = [threading.Thread(target=e.probe, daemon=True) for e in self.endpoints]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(PROBE_TIMEOUT + 1)
+
+    def connect(self, keepAliveIntervalSecond=30):
+        self.keep_alive = keepAliveIntervalSecond
+        self._stopped.clear()
+        self.probe()
+        self._failover()
+        if self.probe_interval and len(self.endpoints) > 1 and self._prober is None:
+            self._prober = threading.Thread(target=self._probe_loop, name='failover', daemon=True)
+            self._prober.start()
+        return True
+
+    def disconnect(self):
+        self._stopped.set()
+        with self._lock:
+            client, self.client, self.active = self.client, None, None
+        if client is not None:
+            client.disconnect()
+        return True
+
+    def publish(self, topic, payload, QoS):
+        with self._lock:
+            client, active = self.client, self.active
+        if client is None:
+            raise ConnectionError('not connected')
+        start = time.perf_counter()
+        result = client.publish(topic, payload, QoS)
+        if QoS:
+            iot.metrics.histogram('endpoint_ack_seconds', endpoint=active.name).observe(
+                time.perf_counter() - start)
+        return result
+
+    def subscribe(self, topic, QoS, callback):
+        with self._lock:
+            self._subscriptions.append((topic, QoS, callback))
+            client = self.client
+        if client is None:
+            return True
+        return client.subscribe(topic, QoS, functools.partial(self._deliver, client, callback))
+
+    def _failover(self, exclude=None):
+        """Connects to the best endpoint, backing off with full jitter after each round that fails"""
+        attempt = 0
+        while not self._stopped.is_set():
+            for endpoint in self.ranked(exclude):
+                if self._connect(endpoint):
+                    return True
+            exclude = None
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            attempt += 1
+            self._logger.warning('no endpoint reachable, retrying in {:.1f}s'.format(delay))
+            self._stopped.wait(delay)
+        return False
+
+    def _connect(self, endpoint):
+        iot.metrics.counter('connect_attempts_total', endpoint=endpoint.name).inc()
+        client = self.factory(endpoint.host, endpoint.port)
+        start = time.perf_counter()
+        try:
+            client.connect(self.keep_alive)
+            for topic, qos, callback in list(self._subscriptions):
+                client.subscribe(topic, qos, functools.partial(self._deliver, client, callback))
+        except Exception as err:
+            endpoint.healthy = False
+            iot.metrics.counter('connect_failures_total', endpoint=endpoint.name).inc()
+            self._logger.warning('{} {}'.format(endpoint.name, err))
+            self._close(client)
+            return False
+        iot.metrics.histogram('connect_seconds', endpoint=endpoint.name).observe(time.perf_counter() - start)
+        client.onOnline = functools.partial(self._online, client)
+        client.onOffline = functools.partial(self._offline, client)
+        with self._lock:
+            old, previous = self.client, self.active
+            self.client, self.active = client, endpoint
+        if previous is not None and previous is not endpoint:
+            iot.metrics.counter('failovers_total').inc()
+            self._logger.warning('connected to {}'.format(endpoint.name))
+        if old is not None:
+            self._close(old)
+        self._online(client)
+        return True
+
+    @staticmethod
+    def _close(client):
+        """Disconnects a client for good, so it neither reconnects nor delivers anything"""
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+    def _deliver(self, client, callback, *args):
+        if client is self.client:  # messages of a replaced connection are dropped
+            callback(*args)
+
+    def _online(self, client):
+        if client is self.client and self.onOnline is not None:
+            self.onOnline()
+
+    def _offline(self, client):
+        with self._lock:
+            if client is not self.client:
+                return  # a connection that was replaced
+            self.client = None
+            endpoint = self.active
+        endpoint.healthy = False
+        if self.onOffline is not None:
+            self.onOffline()
+        threading.Thread(target=self._replace, args=(client, endpoint), name='failover', daemon=True).start()
+
+    def _replace(self, client, endpoint):
+        self._close(client)  # stops its own reconnects, the manager picks the next endpoint
+        if not self._failing_over.acquire(blocking=False):
+            return  # already failing over
+        try:
+            self._failover(exclude=endpoint)
+        finally:
+            self._failing_over.release()
+
+    def _probe_loop(self):
+        # runs for the life of the manager, a disconnect only pauses it until the next connect
+        while True:
+            time.sleep(self.probe_interval)
+            if self._stopped.is_set() or self.active is None:
+                continue
+            self.probe()
+            active = self.active
+            best = self.ranked()[0]
+            if active is not None and best is not active and best.healthy and \
+                    best.score() < SWITCH_RATIO * active.score():
+                self._logger.warning('switching from {} to faster {}'.format(active.name, best.name))
+                with self._failing_over:
+                    if self.client is not None and self.active is active:  # not failed over meanwhile
+                        self._connect(best)
@@ -0,0 +1,200 @@
+import fcntl
+import glob
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import iot
+
+# Linux GPIO character device, uAPI v2 (linux/gpio.h, kernel 5.10+)
+GPIO_GET_CHIPINFO_IOCTL = 0x8044B401
+GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+GPIO_V2_LINE_GET_VALUES_IOCTL = 0xC010B40E
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN = 1 << 9
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+CHIPINFO = struct.Struct('<32s32sI')  # name, label, lines
+# offsets[64], consumer, config (flags, num_attrs, padding, attrs[10]), num_lines, event_buffer_size, padding, fd
+REQUEST = struct.Struct('<64I32sQI20x240sII20xi')
+ATTRIBUTE = struct.Struct('<I4xQQ')  # id, value, mask
+VALUES = struct.Struct('<QQ')  # bits, mask
+EVENT = struct.Struct('<QIIII24x')  # timestamp_ns (CLOCK_MONOTONIC), id, offset, seqno, line_seqno
+
+CONSUMER = b'slice'
+EVENT_BUFFER = 64  # events the kernel queues per line
+PI_CHIPS = (b'pinctrl-bcm2835', b'pinctrl-bcm2711', b'pinctrl-rp1')  # BCM pin numbers are their offsets
+
+
+def chip_label(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        info = fcntl.ioctl(fd, GPIO_GET_CHIPINFO_IOCTL, bytes(CHIPINFO.size))
+    finally:
+        os.close(fd)
+    return CHIPINFO.unpack(info)[1].rstrip(b'\0')
+
+
+def find_chip():
+    """Returns the gpiochip of the Raspberry Pi header pins, the first chip on other boards"""
+    paths = sorted(glob.glob('/dev/gpiochip*'), key=lambda p: int(p[len('/dev/gpiochip'):]))
+    if not paths:
+        raise OSError('no GPIO character device')
+    for path in paths:
+        try:
+            if chip_label(path) in PI_CHIPS:
+                return path
+        except OSError:
+            pass
+    return paths[0]
+
+
+def request_line(chip_fd, offset, flags, debounce=None):
+    """Requests one line of a chip, returns the line fd that reads its edge events"""
+    attrs = b''
+    if debounce:
+        attrs = ATTRIBUTE.pack(GPIO_V2_LINE_ATTR_ID_DEBOUNCE, int(debounce * 1e6), 1)
+    request = bytearray(REQUEST.pack(offset, *[0] * 63, CONSUMER, flags, len(attrs) // ATTRIBUTE.size,
+                                     attrs.ljust(240, b'\0'), 1, EVENT_BUFFER, 0))
+    fcntl.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, request, True)
+    return REQUEST.unpack(request)[-1]
+
+
+def line_value(fd):
+    values = bytearray(VALUES.pack(0, 1))
+    fcntl.ioctl(fd, GPIO_V2_LINE_GET_VALUES_IOCTL, values, True)
+    return VALUES.unpack(values)[0] & 1
+
+
+class Line:
+    """A requested input line; the first callback fires when it becomes active, the second when inactive"""
+    callbacks = ('when_activated', 'when_deactivated')
+
+    def __init__(self, fd, pin, active_low=False, value=0):
+        self.fd = fd
+        self.pin = pin
+        self.active_low = active_low
+        self.is_active = bool(value) != active_low
+        self.line_seqno = 0
+        for name in self.callbacks:
+            setattr(self, name, None)
+
+    def edge(self, event_id):
+        """Returns whether an edge makes the line active"""
+        return (event_id == GPIO_V2_LINE_EVENT_RISING_EDGE) != self.active_low
+
+
+class Button(Line):
+    callbacks = ('when_pressed', 'when_released')
+
+    @property
+    def is_pressed(self):
+        return self.is_active
+
+
+class MotionSensor(Line):
+    """Digital output of a PIR sensor, which does its own hold and filtering"""
+    callbacks = ('when_motion', 'when_no_motion')
+
+    @property
+    def motion_detected(self):
+        return self.is_active
+
+
+class EdgeCapture:
+    """Captures the edges of many lines of a GPIO character device from one epoll thread.
+
+    The kernel timestamps every edge when it happens and queues it on its line. Each wakeup reads
+    the queued events of all ready lines in one read per line, orders them by timestamp and calls
+    the callbacks with the wall clock time of the edge, so a loaded CPU delays events but doesn't
+    reorder, merge or misdate them.
+    """
+
+    def __init__(self, chip=None):
+        self.chip = chip if chip else find_chip()
+        self.lines = {}  # fd -> Line
+        self._chip_fd = os.open(self.chip, os.O_RDWR)
+        self._epoll = select.epoll()
+        self._logger = logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._run, name='gpiochip', daemon=True)
+        self._delay = iot.metrics.histogram('gpio_event_delay_seconds')
+        self._events = iot.metrics.counter('gpio_events_total')
+        self._lost = iot.metrics.counter('gpio_events_lost_total')
+
+    def add(self, line_class, pin, pull_up=False, active_low=None, bounce_time=None):
+        flags = GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EDGE_FALLING
+        if pull_up is not None:
+            flags |= GPIO_V2_LINE_FLAG_BIAS_PULL_UP if pull_up else GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN
+        fd = request_line(self._chip_fd, pin, flags, bounce_time)
+        line = line_class(fd, pin, bool(pull_up) if active_low is None else active_low, line_value(fd))
+        self.register(line)
+        return line
+
+    def register(self, line):
+        self.lines[line.fd] = line
+        self._epoll.register(line.fd, select.EPOLLIN)
+
+    def button(self, pin, pull_up=True, bounce_time=None):
+        """Returns a Button pressed when pulled to the inactive level, like gpiozero.Button"""
+        return self.add(Button, pin, pull_up, bounce_time=bounce_time)
+
+    def motion_sensor(self, pin, pull_up=False):
+        return self.add(MotionSensor, pin, pull_up)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def poll(self, timeout=-1):
+        """Waits for edges, returns the [(line, active, timestamp)] that changed state, oldest first"""
+        events = []
+        for fd, _ in self._epoll.poll(timeout):
+            line = self.lines[fd]
+            data = os.read(fd, EVENT.size * EVENT_BUFFER)
+            for timestamp_ns, event_id, _, _, line_seqno in EVENT.iter_unpack(data):
+                if line.line_seqno and line_seqno > line.line_seqno + 1:
+                    self._lost.inc(line_seqno - line.line_seqno - 1)  # the kernel queue overflowed
+                line.line_seqno = line_seqno
+                events.append((timestamp_ns, line, line.edge(event_id)))
+        if not events:
+            return []
+        events.sort(key=lambda e: e[0])
+        now = time.monotonic_ns()
+        offset = time.time_ns() - now  # event timestamps are CLOCK_MONOTONIC
+        changed = []
+        for timestamp_ns, line, active in events:
+            self._events.inc()
+            self._delay.observe((now - timestamp_ns) / 1e9)
+            if active != line.is_active:
+                line.is_active = active
+                changed.append((line, active, (timestamp_ns + offset) / 1e9))
+        return changed
+
+    def _run(self):
+        while True:
+            for line, active, timestamp in self.poll():
+                callback = getattr(line, line.callbacks[0 if active else 1])
+                if callback is not None:
+                    try:
+                        callback(timestamp)
+                    except Exception as err:
+                        self._logger.error('pin {} {}'.format(line.pin, err))
+
+
+def add_arguments(parser):
+    parser.add_argument("--gpiod", action="store_true", default=False,
+                        help="Capture kernel timestamped edges from the GPIO character device instead of gpiozero")
+    parser.add_argument("--gpiochip", help="GPIO character device of --gpiod (default: the Raspberry Pi header " +
+                                           "chip, or /dev/gpiochip0)")
+
+
+def from_args(args):
+    """Returns the EdgeCapture selected on the command line, None without --gpiod"""
+    return EdgeCapture(args.gpiochip) if args.gpiod else None
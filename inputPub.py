@@ -1,49 +1,63 @@
 #!/usr/bin/env python
 
+import datetime
 import json
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+import time
 from signal import pause
-from gpiozero import Button
-import argparse
-import platform
-from iot import iot_thing_topic, iot_payload, AllowedActions
-
-
-def publish(topic, value):
-    myAWSIoTMQTTClient.publish(
-        topic,
-        json.dumps({args.shadow_var: value, 'message': "{} {}".format(args.shadow_var, value)}), 1)
-    myAWSIoTMQTTClient.publish(
-        iot_thing_topic(args.thing),
-        iot_payload('reported', {args.shadow_var: value}), 1)
-
-
-def high():
-    publish(args.topic, args.high_value)
-
-
-def low():
-    publish(args.low_topic, args.low_value)
+import logging
+import iot
+from iot import iot_thing_topic, iot_payload, RateLimiter
+from shadow import Coalescer
+import gpiochip
+import spool
+from publisher import Publisher
+
+
+class Input:
+
+    def __init__(self, client, thing, shadow_var, topic, low_topic=None, high_value=1, low_value=0,
+                 shadow=None, limiter=None):
+        self.client = client
+        self.shadow = shadow  # Coalescer merging shadow updates, published directly when None
+        self.limiter = limiter  # RateLimiter capping event messages
+        self.dropped = 0
+        self.thing = thing
+        self.shadow_var = shadow_var
+        self.topic = topic
+        # default low_topic to topic if not defined
+        self.low_topic = low_topic if low_topic else topic
+        self.high_value = high_value
+        self.low_value = low_value
+
+    def publish(self, topic, value, timestamp=None):
+        start = time.perf_counter()
+        if self.limiter is None or self.limiter.allow():
+            doc = {self.shadow_var: value, 'message': "{} {}".format(self.shadow_var, value)}
+            if timestamp is not None:
+                doc['observed'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
+            self.client.publish(topic, json.dumps(doc), 1)
+        else:
+            self.dropped += 1
+            iot.metrics.counter('events_dropped_total').inc()
+            logging.debug('event rate exceeded, dropped {} {}'.format(topic, value))
+        if self.shadow is not None:
+            self.shadow.update(self.thing, {self.shadow_var: value})
+        else:
+            self.client.publish(
+                iot_thing_topic(self.thing),
+                iot_payload('reported', {self.shadow_var: value}), 1)
+        iot.metrics.histogram('edge_to_publish_seconds', source='input').observe(time.perf_counter() - start)
+
+    def high(self, timestamp=None):
+        self.publish(self.topic, self.high_value, timestamp)
+
+    def low(self, timestamp=None):
+        self.publish(self.low_topic, self.low_value, timestamp)
 
 
 if __name__ == "__main__":
     # Read in command-line parameters
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
-                        help="Your AWS IoT custom endpoint")
-    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
-    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
-                        help="Use MQTT over WebSocket")
-    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
-                        help="Targeted client id")
-    parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
-                        help="Operation modes: %s" % str(AllowedActions))
-    parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python", help="Targeted topic")
-    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
-                        help="Targeted thing name")
+    parser = iot.argument_parser()
     parser.add_argument("--pin", action="store", dest="pin", help="gpio pin (using BCM numbering)", type=int)
     parser.add_argument("-u", "--pull_up",
                         help="If True (the default), the GPIO pin will be pulled high by default. " +
@@ -61,55 +75,43 @@ if __name__ == "__main__":
     parser.add_argument("-z", "--low_value", help="low value", default=0)
     parser.add_argument("-o", "--low_topic", action="store", dest="low_topic",
                         help="Low topic (defaults to topic if not assigned")
+    parser.add_argument("--shadow_window", help="Seconds shadow updates are merged before publishing (0 = disabled)",
+                        type=float, default=0.2)
+    parser.add_argument("--event_rate", help="Maximum event messages per second (0 = unlimited)",
+                        type=float, default=0)
+    spool.add_arguments(parser)
+    gpiochip.add_arguments(parser)
     args = parser.parse_args()
+    iot.validate_args(parser, args)
+    spool.validate_args(parser, args)
 
-    if args.mode not in AllowedActions:
-        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
-        exit(2)
-
-    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
-        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
-        exit(2)
+    # Configure logging
+    iot.start_logging(args)
 
-    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
-        parser.error("Missing credentials for authentication.")
-        exit(2)
-
-    # Port defaults
-    port = args.port
-    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
-        port = 443
-    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
-        port = 8883
-
-    # Init AWSIoTMQTTClient
-    myAWSIoTMQTTClient = None
-    if args.useWebsocket:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId, useWebsocket=True)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath)
+    # Connect to AWS IoT, through the sender thread when messages are spooled
+    if args.spool:
+        myAWSIoTMQTTClient = iot.connect_from_args(args, connect=False, offline_queueing=0)
+        sink = Publisher(myAWSIoTMQTTClient, spool=spool.from_args(args)).start()
     else:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
-
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
-
-    # Connect and subscribe to AWS IoT
-    myAWSIoTMQTTClient.connect()
+        myAWSIoTMQTTClient = iot.connect_from_args(args)
+        sink = myAWSIoTMQTTClient
 
-    inp = Button(args.pin, pull_up=args.pull_up, bounce_time=args.bounce_time)
-
-    # default low_topic to topic if not defined
-    if args.low_topic is None or len(args.low_topic) == 0:
-        args.low_topic = args.topic
-
-    inp.when_pressed = high
-    inp.when_released = low
+    capture = gpiochip.from_args(args)
+    if capture is not None:
+        inp = capture.button(args.pin, pull_up=args.pull_up, bounce_time=args.bounce_time)
+    else:
+        inp = iot.load('gpiozero').Button(args.pin, pull_up=args.pull_up, bounce_time=args.bounce_time)
+    handler = Input(sink, args.thingName, args.shadow_var, args.topic, args.low_topic,
+                    args.high_value, args.low_value, shadow=Coalescer(sink, args.shadow_window),
+                    limiter=RateLimiter(args.event_rate) if args.event_rate > 0 else None)
+
+    inp.when_pressed = handler.high
+    inp.when_released = handler.low
+    if capture is not None:
+        capture.start()
+    iot.start_metrics(args, sink)
+
+    if args.profile_startup:
+        iot.report_startup()
 
     pause()
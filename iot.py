@@ -1,4 +1,20 @@
+import argparse
+import atexit
+import bisect
+import contextlib
+import functools
+import importlib
 import json
+import logging
+import logging.handlers
+import platform
+import queue
+import sys
+import threading
+import time
+
+_started = time.perf_counter()
+startup = {}  # startup phase -> seconds, filled when profiling
 
 LOG_FORMAT = '%(asctime)s %(filename)-15s %(funcName)-15s %(levelname)-8s %(message)s'
 AllowedActions = ['both', 'publish', 'subscribe']
@@ -6,15 +22,648 @@ TOPIC_STATUS_ON = ['1', 'on']
 TOPIC_STATUS_OFF = ['0', 'off']
 TOPIC_STATUS_TOGGLE = ['toggle']
 TOPIC_STATUS_PULSE = ['blink', 'pulse']
+Transports = ['sdk', 'asyncio']
+FORMAT_JSON = 'json'
+FORMAT_MSGPACK = 'msgpack'
 
 
 def topic_parser(prefix, message_topic):
     return message_topic.replace('{}/'.format(prefix), '').split('/')
 
 
-def iot_thing_topic(thing):
-    return "$aws/things/{}/shadow/update".format(thing)
+def iot_thing_topic(thing, suffix='update'):
+    return "$aws/things/{}/shadow/{}".format(thing, suffix)
 
 
 def iot_payload(target, doc):
     return json.dumps({'state': {target: doc}})
+
+
+class Router:
+    """Dispatches topics to handlers registered against MQTT topic patterns ('+' and '#' wildcards).
+
+    Patterns are compiled into a trie so dispatch costs one lookup per topic level. Wildcard
+    levels are passed to the handler as arguments, converted by the types given at registration;
+    a level that fails conversion doesn't match.
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._root = {}
+        self._latency = metrics.histogram('callback_seconds')
+        self._unmatched = metrics.counter('callback_unmatched_total')
+
+    def add(self, pattern, handler, *types, payload=False):
+        """Registers handler for pattern; with payload the message payload is passed as the last argument"""
+        levels = pattern.split('/')
+        if '#' in levels[:-1]:
+            raise ValueError('# must be the last level of {}'.format(pattern))
+        node = self._root
+        for level in levels:
+            node = node.setdefault(level, {})
+        node[None] = (handler, types, payload)
+
+    def route(self, pattern, *types, payload=False):
+        def decorator(handler):
+            self.add(pattern, handler, *types, payload=payload)
+            return handler
+        return decorator
+
+    def levels(self, topic):
+        if not self.prefix:
+            return topic.split('/')
+        if topic == self.prefix:
+            return []
+        if topic.startswith(self.prefix + '/'):
+            return topic[len(self.prefix) + 1:].split('/')
+        return None
+
+    def match(self, topic):
+        """Returns (handler, args) for the topic or None"""
+        found = self._find(topic)
+        return found[:2] if found is not None else None
+
+    def _find(self, topic):
+        levels = self.levels(topic)
+        if levels is None:
+            return None
+        return self._match(self._root, levels, 0, ())
+
+    def _match(self, node, levels, i, captured):
+        if i == len(levels):
+            if None in node:
+                found = self._convert(node[None], captured)
+                if found is not None:
+                    return found
+            if '#' in node:  # '#' also matches the parent level
+                return self._convert(node['#'][None], captured + ([],))
+            return None
+        level = levels[i]
+        if level in node:
+            found = self._match(node[level], levels, i + 1, captured)
+            if found is not None:
+                return found
+        if '+' in node:
+            found = self._match(node['+'], levels, i + 1, captured + (level,))
+            if found is not None:
+                return found
+        if '#' in node:
+            return self._convert(node['#'][None], captured + (levels[i:],))
+        return None
+
+    @staticmethod
+    def _convert(entry, captured):
+        handler, types, payload = entry
+        try:
+            return handler, [t(v) for t, v in zip(types, captured)] + list(captured[len(types):]), payload
+        except (TypeError, ValueError):
+            return None
+
+    def dispatch(self, topic, payload=None):
+        """Calls the handler registered for the topic, returns False if there is none"""
+        start = time.perf_counter()
+        found = self._find(topic)
+        if found is None:
+            self._unmatched.inc()
+            return False
+        handler, args, wants_payload = found
+        if wants_payload:
+            args.append(payload)
+        try:
+            handler(*args)
+        finally:
+            self._latency.observe(time.perf_counter() - start)
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def serializer(fmt=FORMAT_JSON):
+    """Returns the (dumps, loads) functions of a payload format, built once per format"""
+    if fmt == FORMAT_MSGPACK:
+        msgpack = load('msgpack')
+        return functools.partial(msgpack.packb, use_bin_type=True), functools.partial(msgpack.unpackb, raw=False)
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    decoder = json.JSONDecoder()
+    return encoder.encode, lambda payload: decoder.decode(
+        payload.decode('utf-8') if isinstance(payload, (bytes, bytearray)) else payload)
+
+
+def payload_format(payload):
+    """JSON documents start with '{' or '[', any other payload is taken as msgpack"""
+    first = payload.lstrip()[:1]
+    return FORMAT_JSON if first in (b'{', b'[', '{', '[') else FORMAT_MSGPACK
+
+
+def decode(payload):
+    """Returns (format, document) of a JSON or msgpack payload"""
+    fmt = payload_format(payload)
+    return fmt, serializer(fmt)[1](payload)
+
+
+def encode(doc, fmt=FORMAT_JSON):
+    return serializer(fmt)[0](doc)
+
+
+class Batch:
+    """Runs the commands of one payload on many targets and answers with one reply.
+
+    The JSON or msgpack payload {"id": 7, "commands": [{"target": "22", "command": "pulse/3"}, ...]}
+    (or just the list of commands) runs every command with execute(item) of its target and
+    publishes {"id": 7, "results": [{"target": "22", "command": "pulse/3", "ok": true}, ...]} to
+    <topic>-reply, in the format of the request. With one target "target" can be left out.
+
+    The reply is published from the subscription callback. The SDK handles PUBACKs on that same
+    thread, so a QoS 1 reply would wait out the operation timeout; it goes out at QoS 0.
+    """
+
+    def __init__(self, client, topic, targets, qos=0):
+        self.client = client
+        self.topic = '{}/batch'.format(topic)
+        self.reply_topic = '{}-reply'.format(topic)
+        self.targets = targets  # target name -> handler
+        self.qos = qos
+
+    def execute(self, payload):
+        try:
+            fmt, doc = decode(payload)
+            items = doc.get('commands', []) if isinstance(doc, dict) else doc
+            items = list(items)
+        except Exception as err:
+            logging.warning('invalid batch {}: {}'.format(payload, err))
+            return None
+        results = [self.run(item) for item in items]
+        reply = {'results': results}
+        if isinstance(doc, dict) and 'id' in doc:
+            reply['id'] = doc['id']
+        try:
+            self.client.publish(self.reply_topic, encode(reply, fmt), self.qos)
+        except Exception as err:
+            logging.warning('batch reply {} failed: {}'.format(self.reply_topic, err))
+        return results
+
+    def run(self, item):
+        result = {'target': None, 'command': None}
+        try:
+            if not isinstance(item, dict):
+                raise TypeError('{!r} is not a command object'.format(item))
+            result.update(target=item.get('target'), command=item.get('command', item.get('pattern')))
+            if 'target' in item:
+                target = self.targets[str(item['target'])]
+            elif len(self.targets) == 1:
+                target, = self.targets.values()
+            else:
+                raise KeyError('no target')
+            target.execute(item)
+            result['ok'] = True
+        except Exception as err:
+            result['ok'] = False
+            result['error'] = '{} {}'.format(type(err).__name__, err)
+        metrics.counter('batch_commands_total', ok=result['ok']).inc()
+        return result
+
+    def subscriptionCallback(self, client, userdata, message):
+        self.execute(message.payload)
+
+
+class RateLimiter:
+    """Token bucket allowing rate events per second with bursts of up to burst events"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class LogLimiter(logging.Filter):
+    """Rate limits each logging call site, dropping repeats of the last message within window seconds.
+
+    The next record let through from a call site reports how many were suppressed.
+    """
+
+    def __init__(self, rate=1, burst=10, window=60):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self._sites = {}  # (logger, level, file, line) -> [RateLimiter, last message, last time, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        message = record.getMessage()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [RateLimiter(self.rate, self.burst), None, 0, 0]
+            limiter, last, last_time, suppressed = site
+            if (message == last and record.created - last_time < self.window) or not limiter.allow():
+                site[3] += 1
+                return False
+            site[1:] = [message, record.created, 0]
+        if suppressed:
+            metrics.counter('log_suppressed_total').inc(suppressed)
+            record.msg = '{} (suppressed {} similar messages)'.format(message, suppressed)
+            record.args = None
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the logging thread without blocking, counting the records dropped when it is full"""
+
+    def prepare(self, record):
+        # formatting happens on the logging thread, only the message arguments are merged here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.counter('log_dropped_total').inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        doc = {'time': round(record.created, 3), 'level': record.levelname, 'logger': record.name,
+               'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            doc['exception'] = self.formatException(record.exc_info)
+        return json.dumps(doc)
+
+
+_log_listener = None
+
+
+def setup_logging(level=logging.WARN, json_format=False, rate=1, burst=10, queue_size=10000, stream=None):
+    """Sends the root logger through a bounded queue to a stderr writer thread.
+
+    Logging calls only filter and enqueue their record, they never wait on log I/O. Each call site
+    is rate limited to rate records per second with bursts of burst records.
+    """
+    global _log_listener
+    stop_logging()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+    records = queue.Queue(queue_size)
+    queue_handler = LogQueueHandler(records)
+    queue_handler.addFilter(LogLimiter(rate, burst))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    metrics.gauge('log_queue').fn = records.qsize
+    _log_listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _log_listener.start()
+    return _log_listener
+
+
+@atexit.register
+def stop_logging():
+    """Writes out the queued records and stops the logging thread"""
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def start_logging(args, level=logging.WARN):
+    """Sets up logging with the level, format and rate selected on the command line"""
+    return setup_logging(getattr(logging, args.log_level) if args.log_level else level, args.log_json,
+                         args.log_rate, args.log_burst)
+
+
+@contextlib.contextmanager
+def profile(phase):
+    """Records how long a startup phase takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup[phase] = time.perf_counter() - start
+
+
+def load(name):
+    """Imports a module on first use, so --help and unused features don't pay for heavy imports"""
+    if name in sys.modules:
+        return sys.modules[name]
+    with profile('import {}'.format(name)):
+        return importlib.import_module(name)
+
+
+def report_startup():
+    """Writes the startup phase timings (ms) to stderr"""
+    startup['ready'] = time.perf_counter() - _started
+    sys.stderr.write(json.dumps({k: round(v * 1000, 1) for k, v in startup.items()}) + '\n')
+
+
+def argument_parser(topic=True):
+    """Returns a parser with the command-line options shared by every entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
+                        help="Your AWS IoT custom endpoint")
+    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
+    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
+    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
+    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
+    parser.add_argument("--failover", action="append", dest="failover", metavar="HOST[:PORT][=WEIGHT]",
+                        help="Further endpoint, repeat for several; the fastest healthy endpoint is used")
+    parser.add_argument("--probe_interval", help="Seconds between endpoint probes with --failover", type=float,
+                        default=60)
+    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
+                        help="Use MQTT over WebSocket")
+    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
+                        help="Targeted client id")
+    if topic:
+        parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
+                            help="Operation modes: %s" % str(AllowedActions))
+        parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python",
+                            help="Targeted topic")
+    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
+                        help="Targeted thing name")
+    parser.add_argument("--transport", action="store", dest="transport", default="sdk",
+                        help="MQTT transport: %s" % str(Transports))
+    parser.add_argument("--profile-startup", action="store_true", dest="profile_startup", default=False,
+                        help="Report import and connection timings on stderr")
+    parser.add_argument("--metrics_port", help="Serve metrics on http://localhost:<port>/metrics (0 = disabled)",
+                        type=int, default=0)
+    parser.add_argument("--metrics_interval", help="Seconds between metrics published to <thingName>/metrics " +
+                                                   "(0 = disabled)", type=float, default=0)
+    parser.add_argument("--record", help="Record every message sent and received to segments in this directory " +
+                                         "(see recorder.py)")
+    add_logging_arguments(parser)
+    return parser
+
+
+def add_logging_arguments(parser):
+    parser.add_argument("--log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="Lowest level logged (default WARNING)")
+    parser.add_argument("--log_json", action="store_true", default=False, help="Log one JSON object per line")
+    parser.add_argument("--log_rate", help="Records per second logged from one call site, the rest are counted",
+                        type=float, default=1)
+    parser.add_argument("--log_burst", help="Records logged at once from one call site before --log_rate applies",
+                        type=int, default=10)
+
+
+def validate_args(parser, args):
+    if getattr(args, 'mode', 'both') not in AllowedActions:
+        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
+        exit(2)
+
+    if args.transport not in Transports:
+        parser.error("Unknown --transport option %s. Must be one of %s" % (args.transport, str(Transports)))
+        exit(2)
+
+    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
+        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
+        exit(2)
+
+    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
+        parser.error("Missing credentials for authentication.")
+        exit(2)
+
+
+def connect_from_args(args, connect=True, offline_queueing=-1):
+    """Returns an MQTT client configured from the shared command-line options, connected unless asked not to"""
+    # Port defaults
+    port = args.port
+    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
+        port = 443
+    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
+        port = 8883
+
+    if args.transport == 'asyncio':
+        client_class = load('transport').ThreadedClient
+    else:
+        client_class = load('AWSIoTPythonSDK.MQTTLib').AWSIoTMQTTClient
+
+    def make_client(host, port):
+        # Init AWSIoTMQTTClient
+        if args.useWebsocket:
+            client = client_class(args.clientId, useWebsocket=True)
+            client.configureEndpoint(host, port)
+            client.configureCredentials(args.rootCAPath)
+        else:
+            client = client_class(args.clientId)
+            client.configureEndpoint(host, port)
+            client.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
+
+        # AWSIoTMQTTClient connection configuration
+        client.configureAutoReconnectBackoffTime(1, 32, 20)
+        client.configureOfflinePublishQueueing(offline_queueing)  # -1 infinite, 0 disabled
+        client.configureDrainingFrequency(2)  # Draining: 2 Hz
+        client.configureConnectDisconnectTimeout(10)  # 10 sec
+        client.configureMQTTOperationTimeout(5)  # 5 sec
+        return client
+
+    if getattr(args, 'failover', None):
+        failover = load('failover')
+        endpoints = [failover.Endpoint(args.host, port)] + [failover.parse_endpoint(spec, port)
+                                                            for spec in args.failover]
+        client = failover.ConnectionManager(endpoints, make_client, args.probe_interval)
+    else:
+        client = make_client(args.host, port)
+
+    if getattr(args, 'record', None):
+        recorder = load('recorder')
+        client = recorder.RecordingClient(client, recorder.Recorder(args.record))
+
+    if connect:
+        with profile('connect'):
+            client.connect()
+    return client
+
+
+# latency histogram bucket upper bounds, 4 per power of two from 10 us to ~170 s
+BUCKETS = [1e-5 * 2 ** (i / 4.0) for i in range(96)]
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge:
+    """Value set by the owner, or read from fn when collected"""
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.fn() if self.fn is not None else self._value
+
+
+class Histogram:
+    """Latency histogram with log-spaced buckets (about 19% wide) for cheap percentiles"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class Metrics:
+    """Registry of named metrics; labels become part of the key"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, (kind, factory()))
+        return metric[1]
+
+    def counter(self, name, **labels):
+        return self._get('counter', name, labels, Counter)
+
+    def gauge(self, name, fn=None, **labels):
+        return self._get('gauge', name, labels, lambda: Gauge(fn))
+
+    def histogram(self, name, **labels):
+        return self._get('histogram', name, labels, Histogram)
+
+    @staticmethod
+    def _name(name, labels, extra=()):
+        labels = labels + tuple(extra)
+        if not labels:
+            return name
+        return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+        family = None
+        for (name, labels), (kind, metric) in sorted(self._metrics.items()):
+            value = metric.value if kind != 'histogram' else None
+            if kind == 'gauge' and value is None:
+                continue
+            if name != family:  # one TYPE line per family, the label sets of a family sort together
+                lines.append('# TYPE {} {}'.format(name, kind))
+                family = name
+            if kind != 'histogram':
+                lines.append('{} {}'.format(self._name(name, labels), value))
+                continue
+            cumulative = 0
+            last = max((i for i, n in enumerate(metric.counts[:-1]) if n), default=-1)
+            for i in range(last + 1):
+                cumulative += metric.counts[i]
+                lines.append('{} {}'.format(self._name(name + '_bucket', labels, [('le', '%.6g' % BUCKETS[i])]),
+                                            cumulative))
+            lines.append('{} {}'.format(self._name(name + '_bucket', labels, [('le', '+Inf')]), metric.count))
+            lines.append('{} {}'.format(self._name(name + '_sum', labels), metric.sum))
+            lines.append('{} {}'.format(self._name(name + '_count', labels), metric.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Returns the metrics as a dict, histograms summarised by count and percentiles"""
+        doc = {}
+        for (name, labels), (kind, metric) in sorted(self._metrics.items()):
+            if kind == 'histogram':
+                doc[self._name(name, labels)] = {'count': metric.count, 'p50': metric.quantile(0.5),
+                                                 'p99': metric.quantile(0.99), 'max': metric.max}
+            else:
+                doc[self._name(name, labels)] = metric.value
+        return doc
+
+
+metrics = Metrics()
+
+
+def serve_metrics(port, registry=None):
+    """Serves /metrics on localhost from a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    registry = registry if registry is not None else metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def publish_metrics(client, thing, interval, registry=None):
+    """Publishes a metrics snapshot to <thing>/metrics every interval seconds from a background thread"""
+    registry = registry if registry is not None else metrics
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                client.publish('{}/metrics'.format(thing), json.dumps(registry.snapshot()), 0)
+            except Exception as err:
+                logging.warning('metrics {}'.format(err))
+    threading.Thread(target=run, name='metrics', daemon=True).start()
+
+
+def start_metrics(args, client, thing=None):
+    """Starts the metrics endpoint and/or topic selected on the command line"""
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    if args.metrics_interval:
+        publish_metrics(client, thing or args.thingName, args.metrics_interval)
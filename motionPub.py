@@ -1,50 +1,49 @@
 #!/usr/bin/env python
 
-from iot import AllowedActions, LOG_FORMAT
-import platform
-import argparse
+import iot
 from signal import pause
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-from gpiozero import MotionSensor
 import logging
 import json
 import datetime
-
-
-def motion():
-    logging.info('Motion')
-    try:
-        myAWSIoTMQTTClient.connect()
-        myAWSIoTMQTTClient.publish(args.topic, json.dumps(
-            {'thing': args.thingName,
-             'observed': datetime.datetime.now().isoformat()}), 0)
-        myAWSIoTMQTTClient.disconnect()
-    except Exception as err:
-        logging.warning('{}'.format(err))
-
-
-def no_motion():
-    logging.info('No Motion')
+import time
+from publisher import Publisher
+from occupancy import Sessionizer
+from sampler import Sampler
+import gpiochip
+import spool
+
+
+class Motion:
+
+    def __init__(self, client, thing, topic, ephemeral=False):
+        self.client = client
+        self.thing = thing
+        self.topic = topic
+        self.ephemeral = ephemeral
+
+    def motion(self, timestamp=None):
+        logging.info('Motion')
+        start = time.perf_counter()
+        observed = datetime.datetime.fromtimestamp(timestamp) if timestamp is not None else datetime.datetime.now()
+        payload = json.dumps({'thing': self.thing, 'observed': observed.isoformat()})
+        if not self.ephemeral:
+            self.client.publish(self.topic, payload, 0)
+            iot.metrics.histogram('edge_to_publish_seconds', source='motion').observe(time.perf_counter() - start)
+            return
+        try:
+            self.client.connect()
+            self.client.publish(self.topic, payload, 0)
+            self.client.disconnect()
+        except Exception as err:
+            logging.warning('{}'.format(err))
+
+    def no_motion(self, timestamp=None):
+        logging.info('No Motion')
 
 
 if __name__ == "__main__":
     # Read in command-line parameters
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
-                        help="Your AWS IoT custom endpoint")
-    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
-    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
-                        help="Use MQTT over WebSocket")
-    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
-                        help="Targeted client id")
-    parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
-                        help="Operation modes: %s" % str(AllowedActions))
-    parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python", help="Targeted topic")
-    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
-                        help="Targeted thing name")
+    parser = iot.argument_parser()
     parser.add_argument("--pin", action="store", dest="pin", help="gpio pin (using BCM numbering)", type=int)
     parser.add_argument("-q", "--queue_len",
                         help="The length of the queue used to store values read from the sensor. (1 = disabled)",
@@ -58,51 +57,86 @@ if __name__ == "__main__":
                              "the sensor will be considered active by the is_active property, " +
                              "and all appropriate events will be fired",
                         type=float, default=0.5)
+    parser.add_argument("--sampler", action="store_true", default=False,
+                        help="Sample with sampler.Sampler (one register read per tick on a Pi 1 to 4) " +
+                             "instead of a gpiozero MotionSensor")
+    parser.add_argument("--ephemeral", action="store_true", default=False,
+                        help="Connect, publish and disconnect for every motion event")
+    parser.add_argument("--keep_alive", help="MQTT keep alive interval in seconds", type=int, default=30)
+    parser.add_argument("--queue_size", help="Maximum number of events waiting to be published", type=int,
+                        default=100)
+    parser.add_argument("--heartbeat", help="Seconds of inactivity before a heartbeat is published (0 = disabled)",
+                        type=float, default=0)
+    parser.add_argument("--heartbeat_topic", help="Heartbeat topic (defaults to <thingName>/heartbeat)")
+    parser.add_argument("--session", help="Seconds without motion that close an occupancy session, " +
+                                           "publishing one message per session (0 = one message per event)",
+                        type=float, default=0)
+    parser.add_argument("--summary", help="Seconds between summaries of an open session (0 = disabled)",
+                        type=float, default=0)
+    parser.add_argument("--history", help="Number of raw motion timestamps kept for upload", type=int, default=1024)
+    parser.add_argument("--history_topic", help="Topic requesting the raw motion timestamps, " +
+                                                "published to <history_topic>/events (defaults to <topic>/history)")
+    spool.add_arguments(parser)
+    gpiochip.add_arguments(parser)
     args = parser.parse_args()
+    iot.validate_args(parser, args)
+    spool.validate_args(parser, args)
 
-    if args.mode not in AllowedActions:
-        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
+    if args.spool and args.ephemeral:
+        parser.error("--spool needs a long-lived connection and can't be used with --ephemeral.")
         exit(2)
-
-    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
-        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
+    if args.session and args.ephemeral:
+        parser.error("--session needs a long-lived connection and can't be used with --ephemeral.")
         exit(2)
-
-    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
-        parser.error("Missing credentials for authentication.")
+    if args.gpiod and args.sampler:
+        parser.error("--gpiod and --sampler are alternative inputs, pick one.")
         exit(2)
 
-    # Port defaults
-    port = args.port
-    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
-        port = 443
-    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
-        port = 8883
-
     # Configure logging
-    logging.basicConfig(level=logging.WARN, format=LOG_FORMAT)
-
-    # Init AWSIoTMQTTClient
-    myAWSIoTMQTTClient = None
-    if args.useWebsocket:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId, useWebsocket=True)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath)
-    else:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
-
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
+    iot.start_logging(args)
 
-    pir = MotionSensor(args.pin, queue_len=args.queue_len, sample_rate=args.sample_rate, threshold=args.threshold)
+    myAWSIoTMQTTClient = iot.connect_from_args(args, connect=False, offline_queueing=0 if args.spool else -1)
 
-    pir.when_motion = motion
-    pir.when_no_motion = no_motion
+    # Long-lived connection unless every event should connect on its own
+    if args.ephemeral:
+        handler = Motion(myAWSIoTMQTTClient, args.thingName, args.topic, ephemeral=True)
+    else:
+        if args.heartbeat_topic is None:
+            args.heartbeat_topic = '{}/heartbeat'.format(args.thingName)
+        publisher = Publisher(myAWSIoTMQTTClient, queue_size=args.queue_size, keep_alive=args.keep_alive,
+                              heartbeat=args.heartbeat, heartbeat_topic=args.heartbeat_topic,
+                              spool=spool.from_args(args)).start()
+        if args.session:
+            handler = Sessionizer(publisher, args.thingName, args.topic, args.session, args.summary, args.history)
+        else:
+            handler = Motion(publisher, args.thingName, args.topic)
+
+    capture = gpiochip.from_args(args)
+    if capture is not None:
+        pir = capture.motion_sensor(args.pin)
+    elif args.sampler:
+        sampler = Sampler(args.sample_rate)
+        pir = sampler.add(args.pin, queue_len=args.queue_len, threshold=args.threshold)
+        sampler.start()
+    else:
+        pir = iot.load('gpiozero').MotionSensor(args.pin, queue_len=args.queue_len, sample_rate=args.sample_rate,
+                                                threshold=args.threshold)
+
+    pir.when_motion = handler.motion
+    pir.when_no_motion = handler.no_motion
+    if capture is not None:
+        capture.start()
+    iot.start_metrics(args, handler.client)
+
+    # motion is recorded from the start; history requests are answered once the device is online
+    if args.session:
+        publisher.connected.wait()
+        myAWSIoTMQTTClient.subscribe(args.history_topic or '{}/history'.format(args.topic), 1,
+                                     handler.historyCallback)
+
+    if args.profile_startup:
+        if not args.ephemeral:
+            publisher.connected.wait(15)
+        iot.report_startup()
 
     pause()
@@ -0,0 +1,113 @@
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+from array import array
+from scheduler import Scheduler
+
+RATE_WINDOW = 60  # seconds over which the peak event rate is measured
+
+
+def isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+class History:
+    """Ring buffer of the last size event timestamps (8 bytes each)"""
+
+    def __init__(self, size=1024):
+        self._buffer = array('d', [0.0] * size)
+        self._next = 0
+        self._count = 0
+
+    def append(self, timestamp):
+        self._buffer[self._next] = timestamp
+        self._next = (self._next + 1) % len(self._buffer)
+        self._count = min(self._count + 1, len(self._buffer))
+
+    def events(self, since=0):
+        """Returns the stored timestamps after since, oldest first"""
+        start = (self._next - self._count) % len(self._buffer)
+        ordered = [self._buffer[(start + i) % len(self._buffer)] for i in range(self._count)]
+        return [t for t in ordered if t > since]
+
+    def __len__(self):
+        return self._count
+
+
+class Sessionizer:
+    """Merges motion events into occupancy sessions.
+
+    A session starts with a motion event and closes hold_off seconds after the last one; it is
+    published once when it closes, with in-progress summaries every summary seconds while open.
+    The raw event timestamps are kept in a History and published on request.
+    """
+
+    def __init__(self, client, thing, topic, hold_off=30, summary=0, history=1024, scheduler=None):
+        self.client = client
+        self.thing = thing
+        self.topic = topic
+        self.hold_off = hold_off
+        self.summary = summary
+        self.history = History(history)
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.session = None
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+        self._key = 'session:{}'.format(topic)
+
+    def motion(self, timestamp=None):
+        now = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            self.history.append(now)
+            self._recent.append(now)
+            while self._recent[0] < now - RATE_WINDOW:
+                self._recent.popleft()
+            if self.session is None:
+                self.session = {'start': now, 'end': now, 'count': 0, 'peak': 0}
+                if self.summary:
+                    self.scheduler.schedule(self._key + ':summary', self.summary, self._summary)
+            self.session['end'] = now
+            self.session['count'] += 1
+            self.session['peak'] = max(self.session['peak'], len(self._recent))
+            self.scheduler.schedule(self._key, self.hold_off, self.close)
+
+    def no_motion(self, timestamp=None):
+        logging.debug('No Motion')
+
+    def payload(self, session, closed):
+        return json.dumps({'thing': self.thing, 'start': isoformat(session['start']),
+                           'end': isoformat(session['end']), 'duration': round(session['end'] - session['start'], 3),
+                           'count': session['count'], 'peak_per_minute': session['peak'] * 60 / RATE_WINDOW,
+                           'closed': closed})
+
+    def close(self):
+        """Publishes and ends the open session"""
+        with self._lock:
+            session, self.session = self.session, None
+            self._recent.clear()
+            # under the lock, so a motion() right after can't have its new session's close cancelled
+            self.scheduler.cancel(self._key)
+            self.scheduler.cancel(self._key + ':summary')
+        if session is not None:
+            self.client.publish(self.topic, self.payload(session, True), 1)
+
+    def _summary(self):
+        with self._lock:
+            session = dict(self.session) if self.session is not None else None
+        if session is not None:
+            self.client.publish(self.topic, self.payload(session, False), 0)
+            self.scheduler.schedule(self._key + ':summary', self.summary, self._summary)
+
+    def historyCallback(self, client, userdata, message):
+        """Publishes the stored event timestamps to <request topic>/events, optionally since {"since": epoch}"""
+        try:
+            since = float(json.loads(message.payload or '{}').get('since', 0))
+        except (ValueError, TypeError, AttributeError):
+            since = 0
+        with self._lock:
+            events = self.history.events(since)
+        self.client.publish('{}/events'.format(message.topic),
+                            json.dumps({'thing': self.thing, 'events': events}), 1)
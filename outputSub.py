@@ -2,109 +2,152 @@
 
 import logging
 import time
-import argparse
-import platform
-from iot import topic_parser, AllowedActions, TOPIC_STATUS_OFF, TOPIC_STATUS_ON, TOPIC_STATUS_PULSE, LOG_FORMAT
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-from gpiozero import DigitalOutputDevice
-
-
-def device(cmd):
-    if args.pin is not None:
-        if cmd < 0:
-            output.on()
-        elif cmd == 0:
-            output.off()
-        elif cmd > 0:
-            output.blink(args.on_time, args.off_time, cmd)
-
-
-def subscriptionCallback(client, user_data, message):
-    params = topic_parser(args.topic, message.topic)
-    if params[0] in TOPIC_STATUS_PULSE and len(params) == 1:
-        device(int(args.default))
-    elif params[0] in TOPIC_STATUS_PULSE and len(params) > 1:
-        device(int(params[1]))
-    elif params[0] in TOPIC_STATUS_ON:
-        device(-1)
-    elif params[0] in TOPIC_STATUS_OFF:
-        device(0)
-    else:
-        logging.warning('callback unrecognized command: {}'.format(cmd))
+import iot
+from iot import Router, TOPIC_STATUS_OFF, TOPIC_STATUS_ON, TOPIC_STATUS_PULSE
+from patterns import Pattern, Sequencer
+from shadow import Coalescer, Mirror
+
+
+def command_router(topic, output):
+    """Returns the Router of the command topics of output under topic"""
+    router = Router(topic)
+    # levels after the command are ignored, like pulse/5/extra
+    for status in TOPIC_STATUS_PULSE:
+        router.add(status, lambda: output.pulse())
+        router.add(status + '/+/#', lambda count, extra: output.pulse(count), int)
+    for status in TOPIC_STATUS_ON:
+        router.add(status + '/#', lambda extra: output.on())
+    for status in TOPIC_STATUS_OFF:
+        router.add(status + '/#', lambda extra: output.off())
+    router.add('pattern', lambda payload: output.pattern(payload), payload=True)
+    return router
+
+
+class Output:
+
+    def __init__(self, output, topic, on_time=1, off_time=1, default=1, sequencer=None):
+        self.output = output
+        self.sequencer = sequencer if sequencer is not None else Sequencer()
+        self.topic = topic
+        self.on_time = on_time
+        self.off_time = off_time
+        self.default = default
+        self.router = command_router(topic, self)
+
+    def device(self, cmd):
+        if self.output is not None:
+            if cmd < 0:
+                self.play(Pattern.hold(1))
+            elif cmd == 0:
+                self.play(Pattern.hold(0))
+            elif cmd > 0:
+                self.play(Pattern.blink(self.on_time, self.off_time, cmd))
+
+    def play(self, pattern):
+        if self.output is not None:
+            self.sequencer.play(self.output, pattern)
+
+    def pattern(self, payload):
+        """Plays the pattern of a <topic>/pattern payload, see patterns.Pattern.parse"""
+        try:
+            self.play(Pattern.parse(payload))
+        except (ValueError, KeyError, TypeError) as err:
+            logging.warning('invalid pattern {}: {}'.format(payload, err))
+
+    def set(self, value):
+        """Applies a desired shadow value: on/off, a duty cycle or a pattern document"""
+        if isinstance(value, dict):
+            self.play(Pattern.from_doc(value))
+        elif value in TOPIC_STATUS_ON:
+            self.device(-1)
+        elif value in TOPIC_STATUS_OFF:
+            self.device(0)
+        elif isinstance(value, str):
+            raise ValueError('unknown value {}'.format(value))
+        else:
+            self.play(Pattern.hold(float(value)))
+
+    def execute(self, item):
+        """Runs one command of a batch, {"command": "pulse/3"} or {"pattern": {...}}"""
+        if 'pattern' in item:
+            self.play(Pattern.from_doc(item['pattern']))
+        elif not self.router.dispatch('{}/{}'.format(self.topic, item['command'])):
+            raise ValueError('unknown command')
+
+    def pulse(self, count=None):
+        self.device(self.default if count is None else count)
+
+    def on(self):
+        self.device(-1)
+
+    def off(self):
+        self.device(0)
+
+    def subscriptionCallback(self, client, user_data, message):
+        if not self.router.dispatch(message.topic, message.payload):
+            logging.warning('callback unrecognized command: {}'.format(message.topic))
 
 
 if __name__ == "__main__":
     # Read in command-line parameters
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
-                        help="Your AWS IoT custom endpoint")
-    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
-    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
-                        help="Use MQTT over WebSocket")
-    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
-                        help="Targeted client id")
-    parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
-                        help="Operation modes: %s" % str(AllowedActions))
-    parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python", help="Targeted topic")
-    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
-                        help="Targeted thing name")
-    parser.add_argument("--pin", action="store", dest="pin", help="gpio pin (using BCM numbering)", type=int)
+    parser = iot.argument_parser()
+    parser.add_argument("--pin", action="append", dest="pin", type=int,
+                        help="gpio pin (using BCM numbering), repeat for several pins commanded on <topic>/<pin>/...")
+    parser.add_argument("--pwm", action="store_true", default=False,
+                        help="Drive the pins with PWM so patterns can set duty cycles between 0 and 1")
     parser.add_argument("-x", "--on_time", help="Number of seconds on", type=float, default=1)
     parser.add_argument("-y", "--off_time", help="Number of seconds off", type=float, default=1)
     parser.add_argument("-z", "--default", help="Pattern 0=off, -1=on, 1..n=number of blinks", type=int, default=1)
+    parser.add_argument("-s", "--shadow_var",
+                        help="Shadow variable whose desired state drives the pin (<shadow_var><pin> with several pins)")
+    parser.add_argument("--shadow_window", help="Seconds reported shadow updates are merged before publishing",
+                        type=float, default=0.2)
 
     args = parser.parse_args()
-
-    if args.mode not in AllowedActions:
-        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
-        exit(2)
-
-    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
-        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
-        exit(2)
-
-    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
-        parser.error("Missing credentials for authentication.")
-        exit(2)
-
-    # Port defaults
-    port = args.port
-    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
-        port = 443
-    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
-        port = 8883
+    iot.validate_args(parser, args)
 
     # Configure logging
-    logging.basicConfig(level=logging.WARN, format=LOG_FORMAT)
-
-    output = DigitalOutputDevice(args.pin)
-
-    # Init AWSIoTMQTTClient
-    myAWSIoTMQTTClient = None
-    if args.useWebsocket:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId, useWebsocket=True)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath)
-    else:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
-
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
+    iot.start_logging(args)
+
+    # one sequencer thread plays the patterns of all pins, a single pin keeps its commands directly under the topic
+    gpiozero = iot.load('gpiozero') if args.pin else None
+    sequencer = Sequencer()
+    handlers = []
+    targets = {}  # batch target (pin number) -> handler
+    for pin in args.pin or [None]:
+        output = None
+        if pin is not None:
+            output = gpiozero.PWMOutputDevice(pin) if args.pwm else gpiozero.DigitalOutputDevice(pin)
+        topic = args.topic if len(args.pin or []) <= 1 else '{}/{}'.format(args.topic, pin)
+        handlers.append(Output(output, topic, args.on_time, args.off_time, args.default, sequencer))
+        targets[str(pin)] = handlers[-1]
 
     # Connect and subscribe to AWS IoT
-    myAWSIoTMQTTClient.connect()
+    myAWSIoTMQTTClient = iot.connect_from_args(args)
+
+    # <topic>/batch carries commands for many pins in one message
+    batch = iot.Batch(myAWSIoTMQTTClient, args.topic, targets)
+    if len(handlers) == 1:
+        handlers[0].router.add('batch', batch.execute, payload=True)
+
     if args.mode == 'both' or args.mode == 'subscribe':
-        myAWSIoTMQTTClient.subscribe('{}/#'.format(args.topic), 1, subscriptionCallback)
+        for handler in handlers:
+            myAWSIoTMQTTClient.subscribe('{}/#'.format(handler.topic), 1, handler.subscriptionCallback)
+        if len(handlers) > 1:
+            myAWSIoTMQTTClient.subscribe(batch.topic, 1, batch.subscriptionCallback)
+        if args.shadow_var:
+            # desired shadow state, resynced with one get whenever the connection comes back
+            mirror = Mirror(myAWSIoTMQTTClient, args.thingName,
+                            dict((args.shadow_var if len(handlers) == 1 else args.shadow_var + pin, handler.set)
+                                 for pin, handler in targets.items()),
+                            Coalescer(myAWSIoTMQTTClient, args.shadow_window))
+            mirror.subscribe()
+            myAWSIoTMQTTClient.onOnline = mirror.resync
         time.sleep(2)  # give service time to subscribe
+    iot.start_metrics(args, myAWSIoTMQTTClient)
+
+    if args.profile_startup:
+        iot.report_startup()
 
     while True:
         time.sleep(1)
@@ -0,0 +1,116 @@
+import json
+import threading
+from scheduler import Scheduler
+
+MORSE = {
+    'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.', 'G': '--.', 'H': '....', 'I': '..',
+    'J': '.---', 'K': '-.-', 'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.', 'Q': '--.-', 'R': '.-.',
+    'S': '...', 'T': '-', 'U': '..-', 'V': '...-', 'W': '.--', 'X': '-..-', 'Y': '-.--', 'Z': '--..',
+    '0': '-----', '1': '.----', '2': '..---', '3': '...--', '4': '....-', '5': '.....', '6': '-....',
+    '7': '--...', '8': '---..', '9': '----.',
+}
+
+
+class Pattern:
+    """Sequence of (value, seconds) steps played repeat times (0 = forever), then held at value then"""
+
+    def __init__(self, steps, repeat=1, then=0):
+        self.steps = [(float(value), float(seconds)) for value, seconds in steps]
+        self.repeat = int(repeat)
+        self.then = float(then)
+        if self.repeat != 1 and sum(seconds for _, seconds in self.steps) <= 0:
+            # its steps would all run at once, in the thread playing it
+            raise ValueError('a repeated pattern needs a duration')
+
+    def __iter__(self):
+        played = 0
+        while self.repeat <= 0 or played < self.repeat:
+            for step in self.steps:
+                yield step
+            played += 1
+        yield self.then, 0
+
+    @classmethod
+    def blink(cls, on_time=1, off_time=1, n=1):
+        return cls([(1, on_time), (0, off_time)], n)
+
+    @classmethod
+    def hold(cls, value):
+        return cls([], 1, value)
+
+    @classmethod
+    def morse(cls, text, unit=0.2, value=1, repeat=1):
+        steps = []
+        for word in text.upper().split():
+            for letter in word:
+                for symbol in MORSE.get(letter, ''):
+                    steps += [(value, unit if symbol == '.' else 3 * unit), (0, unit)]
+                steps.append((0, 2 * unit))  # 3 units between letters
+            steps.append((0, 4 * unit))  # 7 units between words
+        return cls(steps, repeat)
+
+    @classmethod
+    def envelope(cls, points, step=0.02, repeat=1, then=0):
+        """PWM duty ramped linearly through [value, seconds] points, seconds counted from the start"""
+        steps = []
+        for (v0, t0), (v1, t1) in zip(points, points[1:]):
+            n = max(int((t1 - t0) / step), 1)
+            steps += [(v0 + (v1 - v0) * i / n, (t1 - t0) / n) for i in range(n)]
+        if points:
+            steps.append((points[-1][0], 0))
+        return cls(steps, repeat, then)
+
+    @classmethod
+    def parse(cls, payload):
+        """Builds a pattern from a JSON payload:
+
+        {"steps": [[1, 0.2], [0, 0.8]], "repeat": 3, "then": 0}
+        {"morse": "SOS", "unit": 0.2, "repeat": 1}
+        {"envelope": [[0, 0], [1, 1.5], [0, 3]], "step": 0.02, "repeat": 0}
+        """
+        return cls.from_doc(json.loads(payload))
+
+    @classmethod
+    def from_doc(cls, doc):
+        if 'morse' in doc:
+            return cls.morse(doc['morse'], doc.get('unit', 0.2), doc.get('value', 1), doc.get('repeat', 1))
+        if 'envelope' in doc:
+            return cls.envelope(doc['envelope'], doc.get('step', 0.02), doc.get('repeat', 1), doc.get('then', 0))
+        return cls(doc['steps'], doc.get('repeat', 1), doc.get('then', 0))
+
+
+class Sequencer:
+    """Plays patterns on any number of outputs from one scheduler thread.
+
+    The first step of a pattern is applied in the caller's thread; the next ones are deadlines on
+    the Scheduler keyed by output, so a new pattern for an output replaces the one playing (last
+    writer wins).
+    """
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self._playing = {}  # id(output) -> step iterator of the current pattern
+        self._lock = threading.Lock()
+
+    def play(self, output, pattern):
+        steps = iter(pattern)
+        with self._lock:
+            self._playing[id(output)] = steps
+            self._step(output, steps)
+
+    def playing(self, output):
+        return id(output) in self._playing
+
+    def _step(self, output, steps):
+        for value, seconds in steps:
+            output.value = value
+            if seconds > 0:
+                self.scheduler.schedule(('pattern', id(output)), seconds, lambda: self._next(output, steps))
+                return
+        del self._playing[id(output)]
+        self.scheduler.cancel(('pattern', id(output)))
+
+    def _next(self, output, steps):
+        with self._lock:
+            if self._playing.get(id(output)) is steps:  # not preempted
+                self._step(output, steps)
@@ -1,118 +1,188 @@
 #!/usr/bin/env python
 
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 import argparse
 import platform
-import subprocess as sp
-import psutil
-import gpiozero
-from iot import iot_thing_topic, iot_payload, AllowedActions, LOG_FORMAT
+import iot
+from iot import iot_thing_topic, iot_payload
 import logging
+import time
+from publisher import Publisher
+import spool
+from sensors import Sensors
+
+# smallest change of a metric that is reported in daemon mode, other properties are reported on any change
+DEFAULT_THRESHOLDS = {
+    'megabytesMemoryFree': 10,
+    'megabytesDiskUsed': 10,
+    'percentCPUUtilization': 5,
+    'cpuTemperature': 1,
+    'coreVoltage': 0.05,
+}
 
-def os_execute(s):
-    """Returns string result of os call"""
-    try:
-        return sp.check_output(s.split()).decode('ASCII').rstrip('\n')
-    except Exception as ex:
-        return None
+
+sensors = Sensors()
 
 
 def get_rpi_cpu_temperature():
-    """Returns raspberry pi cpu temperature in Centigrade"""
-    temp = os_execute('/opt/vc/bin/vcgencmd measure_temp')
-    return float(temp.split('=')[1].strip('\'C'))
+    """Returns raspberry pi cpu temperature in Centigrade, None if it can't be read"""
+    return sensors.read('temperature')
+
+
+def get_properties(cpu_interval=3):
+    """Returns the device properties reported to the shadow.
+
+    With cpu_interval None the CPU utilization is measured since the previous call instead of blocking.
+    """
+    psutil = iot.load('psutil')
+    gpiozero = iot.load('gpiozero')
+    properties = {}
+    # find all network interfaces
+    for i, addrs in psutil.net_if_addrs().items():
+        for k in addrs:
+            family, address, netmask, broadcast, ptp = k
+            if family == 2:
+                properties[i] = address
+    if 'lo' in properties:
+        properties.pop('lo')
+
+    properties["hostname"] = platform.node()
+
+    properties["megabytesMemoryFree"] = sensors.read('memory')
+    if properties["megabytesMemoryFree"] is None:
+        properties["megabytesMemoryFree"] = int(psutil.virtual_memory().available / (1024 * 1024))
+
+    properties["megabytesDiskUsed"] = sensors.read('disk')
+    if properties["megabytesDiskUsed"] is None:
+        properties["megabytesDiskUsed"] = int(psutil.disk_usage('/').used / (1024 * 1024))
+
+    properties['percentCPUUtilization'] = psutil.cpu_percent(interval=cpu_interval)
+
+    properties['cpuTemperature'] = get_rpi_cpu_temperature()
+
+    # firmware readings only exist on a Raspberry Pi
+    throttled = sensors.read('throttled')
+    if throttled is not None:
+        properties['throttled'] = throttled
+    voltage = sensors.read('voltage')
+    if voltage is not None:
+        properties['coreVoltage'] = voltage
+
+    properties["hardware"] = "Raspberry Pi Model {} V{}".format(gpiozero.pi_info().model,
+                                                                gpiozero.pi_info().pcb_revision)
+    return properties
+
+
+def changed(reported, properties, thresholds):
+    """Returns the properties that moved beyond their threshold from the reported values"""
+    delta = {}
+    for key, value in properties.items():
+        if key not in reported:
+            delta[key] = value
+        elif key in thresholds and isinstance(value, (int, float)) and isinstance(reported[key], (int, float)):
+            if abs(value - reported[key]) >= thresholds[key]:
+                delta[key] = value
+        elif value != reported[key]:
+            delta[key] = value
+    return delta
+
+
+class Telemetry:
+    """Reports only changed properties, with a full report every resync reports"""
+
+    def __init__(self, client, thing, thresholds=None, resync=10, properties=None):
+        self.client = client
+        self.thing = thing
+        self.thresholds = DEFAULT_THRESHOLDS if thresholds is None else thresholds
+        self.resync = resync
+        self.properties = properties  # returns the properties to report, get_properties of this device when None
+        self.reported = {}
+        self._count = 0
+        if properties is None:
+            iot.load('psutil').cpu_percent(interval=None)  # start measuring cpu utilization
+
+    def report(self):
+        properties = self.properties() if self.properties is not None else get_properties(cpu_interval=None)
+        if self.resync and self._count % self.resync == 0:
+            delta = properties
+        else:
+            delta = changed(self.reported, properties, self.thresholds)
+        self._count += 1
+        if delta:
+            self.client.publish(iot_thing_topic(self.thing), iot_payload('reported', delta), 1)
+            self.reported.update(delta)
+        return delta
+
+
+def threshold(s):
+    """Parses a name=value threshold argument"""
+    name, _, value = s.partition('=')
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("threshold must be name=value, got {}".format(s))
 
 
 if __name__ == "__main__":
     # Read in command-line parameters
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
-                        help="Your AWS IoT custom endpoint")
-    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
-    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
-                        help="Use MQTT over WebSocket")
-    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
-                        help="Targeted client id")
-    parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
-                        help="Operation modes: %s" % str(AllowedActions))
-    parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python", help="Targeted topic")
-    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
-                        help="Targeted thing name")
+    parser = iot.argument_parser()
+    spool.add_arguments(parser)
+    parser.add_argument("--spool_timeout", help="Seconds to wait for spooled messages to drain", type=float,
+                        default=30)
+    parser.add_argument("-d", "--daemon", action="store_true", default=False,
+                        help="Keep running and report every interval")
+    parser.add_argument("-i", "--interval", help="Seconds between reports in daemon mode", type=float, default=60)
+    parser.add_argument("--resync", help="Report all properties every resync intervals (0 = only changes)",
+                        type=int, default=10)
+    parser.add_argument("--threshold", action="append", type=threshold, default=[],
+                        help="Smallest reported change of a metric as name=value, e.g. cpuTemperature=0.5 " +
+                             "(defaults: %s)" % DEFAULT_THRESHOLDS)
     args = parser.parse_args()
-
-    if args.mode not in AllowedActions:
-        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
-        exit(2)
-
-    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
-        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
-        exit(2)
-
-    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
-        parser.error("Missing credentials for authentication.")
-        exit(2)
+    iot.validate_args(parser, args)
+    spool.validate_args(parser, args)
 
     # Configure logging
-    logging.basicConfig(level=logging.WARN, format=LOG_FORMAT)
-
-    # Port defaults
-    port = args.port
-    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
-        port = 443
-    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
-        port = 8883
-
-    # Init AWSIoTMQTTClient
-    myAWSIoTMQTTClient = None
-    if args.useWebsocket:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId, useWebsocket=True)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath)
+    iot.start_logging(args)
+
+    myAWSIoTMQTTClient = iot.connect_from_args(args, connect=False, offline_queueing=0 if args.spool else -1)
+
+    if args.daemon:
+        if args.spool:
+            sink = Publisher(myAWSIoTMQTTClient, spool=spool.from_args(args)).start()
+        else:
+            with iot.profile('connect'):
+                myAWSIoTMQTTClient.connect()
+            sink = myAWSIoTMQTTClient
+        telemetry = Telemetry(sink, args.thingName, dict(DEFAULT_THRESHOLDS, **dict(args.threshold)), args.resync)
+        iot.start_metrics(args, sink)
+        if args.profile_startup:
+            iot.report_startup()
+        while True:
+            time.sleep(args.interval)
+            try:
+                telemetry.report()
+            except Exception as err:
+                logging.warning('report failed: {}'.format(err))
+    elif args.spool:
+        # publish whatever is spooled, including reports of earlier runs that couldn't be sent
+        publisher = Publisher(myAWSIoTMQTTClient, spool=spool.from_args(args))
+        if args.mode == 'both' or args.mode == 'publish':
+            publisher.publish(iot_thing_topic(args.thingName), iot_payload('reported', get_properties()), 1)
+        publisher.start()
+        if not publisher.flush(args.spool_timeout):
+            logging.warning('spool not drained, messages kept in {}'.format(args.spool))
+        if args.profile_startup:
+            iot.report_startup()
+        if publisher.connected.is_set():
+            myAWSIoTMQTTClient.disconnect()
     else:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
-
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
-
-    # Connect and subscribe to AWS IoT
-    myAWSIoTMQTTClient.connect()
-    if args.mode == 'both' or args.mode == 'publish':
-        properties = {}
-        # find all network interfaces
-        for i in psutil.net_if_addrs():
-            for k in psutil.net_if_addrs()[i]:
-                family, address, netmask, broadcast, ptp = k
-                if family == 2:
-                    properties[i] = address
-        if 'lo' in properties:
-            properties.pop('lo')
-
-        properties["hostname"] = platform.node()
-
-        mem = psutil.virtual_memory()
-        properties["megabytesMemoryFree"] = int(mem.available / (1024 * 1024))
-
-        disk = psutil.disk_usage('/')
-        properties["megabytesDiskUsed"] = int(disk.used / (1024 * 1024))
-
-        properties['percentCPUUtilization'] = psutil.cpu_percent(interval=3)
-
-        properties['cpuTemperature'] = get_rpi_cpu_temperature()
-
-        properties["hardware"] = "Raspberry Pi Model {} V{}".format(gpiozero.pi_info().model,
-                                                                    gpiozero.pi_info().pcb_revision)
-
-        myAWSIoTMQTTClient.publish(
-            iot_thing_topic(args.thingName),
-            iot_payload('reported', properties), 1)
-
-        myAWSIoTMQTTClient.disconnect()
+        # Connect and subscribe to AWS IoT
+        with iot.profile('connect'):
+            myAWSIoTMQTTClient.connect()
+        if args.mode == 'both' or args.mode == 'publish':
+            myAWSIoTMQTTClient.publish(
+                iot_thing_topic(args.thingName),
+                iot_payload('reported', get_properties()), 1)
+            if args.profile_startup:
+                iot.report_startup()
+
+            myAWSIoTMQTTClient.disconnect()
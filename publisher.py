@@ -0,0 +1,123 @@
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+import iot
+
+
+MAX_PACE = 2  # slowest drain, seconds between messages
+
+
+class Publisher:
+    """Publishes over one long-lived connection from a dedicated sender thread.
+
+    Messages wait on a bounded in-memory queue, or on a spool.Spool that keeps them on disk until
+    they have been published. The pause between messages adapts to the connection: it doubles
+    when a publish fails and halves with every success, so a backlog drains as fast as the
+    broker accepts it once the connection is back.
+
+    With connect=False the publisher sends over a client that is already connected and
+    reconnects on its own, leaving its connection and callbacks to the owner.
+    """
+
+    def __init__(self, client, queue_size=100, keep_alive=30, heartbeat=0, heartbeat_topic=None, spool=None,
+                 connect=True):
+        self._client = client
+        self._owner = connect
+        self._queue = spool if spool is not None else queue.Queue(queue_size)
+        self.pace = 0
+        self.keep_alive = keep_alive
+        self.heartbeat = heartbeat
+        self.heartbeat_topic = heartbeat_topic
+        self.connected = threading.Event()
+        self._logger = logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+        if connect:
+            client.onOnline = self._online
+            client.onOffline = self._offline
+        else:
+            self.connected.set()
+        iot.metrics.gauge('publish_queue', fn=self._queue.qsize)
+        iot.metrics.gauge('publish_pace_seconds', fn=lambda: self.pace)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def publish(self, topic, payload, qos=0):
+        """Queues a message for the sender thread, returns False if the queue is full"""
+        try:
+            self._queue.put_nowait((topic, payload, qos))
+            return True
+        except queue.Full:
+            iot.metrics.counter('publish_dropped_total').inc()
+            self._logger.warning('publish queue full, dropped {}'.format(topic))
+            return False
+
+    def flush(self, timeout=None):
+        """Waits until every queued message has been published, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _online(self):
+        self.connected.set()
+
+    def _offline(self):
+        self.connected.clear()
+        self._logger.warning('offline')
+
+    def _connect(self):
+        delay = 1
+        while True:
+            try:
+                with iot.profile('connect'):
+                    self._client.connect(self.keep_alive)
+                self.connected.set()
+                return
+            except Exception as err:
+                self._logger.warning('connect failed: {}'.format(err))
+                time.sleep(delay)
+                delay = min(delay * 2, 32)
+
+    def _send(self, topic, payload, qos):
+        delay = 1
+        failures = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self._client.publish(topic, payload, qos)
+                iot.metrics.histogram('publish_seconds', qos=qos).observe(time.perf_counter() - start)
+                self.pace = self.pace / 2 if self.pace > 0.01 else 0
+                return
+            except Exception as err:
+                failures += 1
+                iot.metrics.counter('publish_errors_total').inc()
+                self.pace = min(max(self.pace * 2, 0.05), MAX_PACE)
+                self._logger.warning('publish {} failed: {}'.format(topic, err))
+                if not self._owner:
+                    time.sleep(delay)
+                # the client reconnects on its own once it has been online, force it if it stays down
+                elif not self.connected.wait(delay) and failures >= 3:
+                    self._connect()
+                    failures = 0
+                delay = min(delay * 2, 32)
+
+    def _run(self):
+        if self._owner:
+            self._connect()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.heartbeat or None)
+            except queue.Empty:
+                self._send(self.heartbeat_topic, json.dumps({'heartbeat': datetime.datetime.now().isoformat()}), 0)
+                continue
+            self._send(*item)
+            self._queue.task_done()
+            if self.pace:
+                time.sleep(self.pace)
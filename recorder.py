@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# Records every inbound and outbound MQTT message of an agent (--record DIR) to rotated binary
+# segments, and replays them into a local broker or straight into the outputSub handlers:
+#
+# python recorder.py /var/lib/slice/record --list
+# python recorder.py /var/lib/slice/record --host localhost --port 1883 --speed 1
+# python recorder.py /var/lib/slice/record --handler output --speed 0
+
+import argparse
+import atexit
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'SLREC1\n'
+HEADER = struct.Struct('<IB')  # length of the body, kind
+CLOCK = struct.Struct('<QQ')  # monotonic ns, wall clock ns at the start of a segment
+TOPIC = struct.Struct('<H')  # topic id, followed by the topic
+MESSAGE = struct.Struct('<QHB')  # monotonic ns, topic id, qos, followed by the payload
+KIND_CLOCK, KIND_TOPIC, KIND_IN, KIND_OUT = range(4)
+Directions = ['in', 'out', 'both']
+
+Record = collections.namedtuple('Record', 'direction timestamp time topic qos payload')
+
+
+class Recorder:
+    """Appends messages to segment files of at most segment_size bytes, keeping the last segments.
+
+    Each segment starts with a clock record and defines the topic ids it uses, so it can be read
+    on its own. Writes are buffered and flushed every flush_interval seconds by a background
+    thread, and when the process exits.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, segments=8, flush_interval=1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = segments
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._dirty = False
+        self._closed = threading.Event()
+        self._open()
+        threading.Thread(target=self._flush_loop, name='recorder', daemon=True).start()
+        atexit.register(self.close)
+
+    def _open(self):
+        existing = segment_paths(self.directory)
+        number = int(os.path.basename(existing[-1]).split('.')[0]) + 1 if existing else 0
+        self._file = open(os.path.join(self.directory, '{:08d}.rec'.format(number)), 'wb')
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        self._topics = {}
+        self._write(KIND_CLOCK, CLOCK.pack(time.monotonic_ns(), time.time_ns()))
+        if self.segments:
+            for path in existing[:max(len(existing) + 1 - self.segments, 0)]:
+                os.unlink(path)
+
+    def _write(self, kind, *parts):
+        length = sum(len(part) for part in parts)
+        self._file.write(HEADER.pack(length, kind))
+        for part in parts:
+            self._file.write(part)
+        self._size += HEADER.size + length
+
+    def record(self, inbound, topic, payload, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        now = time.monotonic_ns()
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._size >= self.segment_size or len(self._topics) > 0xffff:
+                self._file.close()
+                self._open()
+            topic_id = self._topics.get(topic)
+            if topic_id is None:
+                topic_id = self._topics[topic] = len(self._topics)
+                self._write(KIND_TOPIC, TOPIC.pack(topic_id), topic.encode('utf-8'))
+            self._write(KIND_IN if inbound else KIND_OUT, MESSAGE.pack(now, topic_id, qos), payload)
+            self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if self._dirty and not self._file.closed:
+                self._file.flush()
+                self._dirty = False
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._file.close()
+
+
+class RecordingClient:
+    """Wraps an MQTT client, recording what it publishes and what its subscriptions receive"""
+
+    def __init__(self, client, recorder):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_recorder', recorder)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)  # onOnline, onOffline
+
+    def publish(self, topic, payload, QoS):
+        self._recorder.record(False, topic, payload, QoS)
+        return self._client.publish(topic, payload, QoS)
+
+    def disconnect(self):
+        self._recorder.flush()
+        return self._client.disconnect()
+
+    def subscribe(self, topic, QoS, callback):
+        def record(client, userdata, message):
+            self._recorder.record(True, message.topic, message.payload, getattr(message, 'qos', 0))
+            callback(client, userdata, message)
+        return self._client.subscribe(topic, QoS, record)
+
+
+def segment_paths(path):
+    """Returns the segment files of a recording directory in order, or the file path itself"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.rec'))
+
+
+def read_segment(path):
+    """Yields the Records of one segment, read through a memory map"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mem:
+        if mem[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a recording'.format(path))
+        offset = len(MAGIC)
+        topics = {}
+        monotonic = wall = 0
+        while offset + HEADER.size <= len(mem):
+            length, kind = HEADER.unpack_from(mem, offset)
+            body = offset + HEADER.size
+            offset = body + length
+            if offset > len(mem):
+                break  # last record cut short by a crash
+            if kind == KIND_CLOCK:
+                monotonic, wall = CLOCK.unpack_from(mem, body)
+            elif kind == KIND_TOPIC:
+                topic_id, = TOPIC.unpack_from(mem, body)
+                topics[topic_id] = mem[body + TOPIC.size:offset].decode('utf-8')
+            elif kind in (KIND_IN, KIND_OUT):
+                timestamp, topic_id, qos = MESSAGE.unpack_from(mem, body)
+                yield Record('in' if kind == KIND_IN else 'out', timestamp / 1e9,
+                             (wall + timestamp - monotonic) / 1e9, topics[topic_id], qos,
+                             mem[body + MESSAGE.size:offset])
+
+
+def read(path, direction='both'):
+    """Yields the Records of a recording directory or segment file"""
+    for segment in segment_paths(path):
+        for record in read_segment(segment):
+            if direction == 'both' or record.direction == direction:
+                yield record
+
+
+class Message:
+    """Replayed message, shaped like the messages of AWSIoTMQTTClient callbacks"""
+
+    def __init__(self, record):
+        self.topic = record.topic
+        self.payload = record.payload
+        self.qos = record.qos
+
+
+def replay(records, callback, speed=1):
+    """Calls callback(record) for every record, paced like the recording divided by speed (0 = no pauses).
+
+    Returns (records, seconds).
+    """
+    start = time.monotonic()
+    first = None
+    count = 0
+    for record in records:
+        if speed > 0:
+            if first is None:
+                first = record.timestamp
+            delay = start + (record.timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        callback(record)
+        count += 1
+    return count, time.monotonic() - start
+
+
+def output_topic(topic):
+    """Returns the output of a command topic, the longest prefix whose rest outputSub.Output routes, or None"""
+    from outputSub import command_router
+    commands = command_router('', None)
+    levels = topic.split('/')
+    for i in range(len(levels) - 1, 0, -1):
+        if commands.match('/'.join(levels[i:])) is not None:
+            return '/'.join(levels[:i])
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Recording directory or segment file")
+    parser.add_argument("--direction", default="in", help="Messages replayed: %s" % str(Directions))
+    parser.add_argument("--speed", type=float, default=1,
+                        help="Replay speed, 1 = as recorded, 0 = as fast as possible")
+    parser.add_argument("--list", action="store_true", default=False, help="Print the records instead of replaying")
+    parser.add_argument("--host", help="Replay to the MQTT broker on this host (no TLS)")
+    parser.add_argument("--port", type=int, default=1883, help="Port of the --host broker")
+    parser.add_argument("--handler", choices=['output'],
+                        help="Replay straight into outputSub.Output handlers, one per topic prefix")
+    args = parser.parse_args()
+
+    if args.direction not in Directions:
+        parser.error("Unknown --direction %s. Must be one of %s" % (args.direction, str(Directions)))
+        exit(2)
+
+    records = read(args.path, args.direction)
+    if args.list:
+        for record in records:
+            print('{:.6f} {:3} {} q{} {}'.format(record.time, record.direction, record.topic, record.qos,
+                                                 bytes(record.payload)[:80]))
+        exit(0)
+
+    if args.host:
+        import transport
+        client = transport.ThreadedClient('replay-{}'.format(os.getpid()))
+        client.configureEndpoint(args.host, args.port)
+        client.connect()
+        count, seconds = replay(records, lambda r: client.publish(r.topic, bytes(r.payload), r.qos), args.speed)
+        client.disconnect()
+    elif args.handler == 'output':
+        from outputSub import Output
+        handlers = {}
+
+        class NullOutput:
+            """Output device without hardware, the replayed handlers drive it"""
+            value = 0
+
+        def deliver(record):
+            prefix = output_topic(record.topic)
+            if prefix is None:
+                return  # not an output command
+            if prefix not in handlers:
+                handlers[prefix] = Output(NullOutput(), prefix)
+            handlers[prefix].subscriptionCallback(None, None, Message(record))
+        count, seconds = replay(records, deliver, args.speed)
+    else:
+        parser.error("Pick --list, --host or --handler")
+        exit(2)
+
+    print(json.dumps({'messages': count, 'seconds': round(seconds, 3),
+                      'messages_per_s': round(count / seconds, 1) if seconds else None}))
@@ -0,0 +1,84 @@
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import iot
+
+# events of each source, the first one is the default of a rule
+EVENTS = {'input': ('pressed', 'released'), 'motion': ('motion', 'no_motion')}
+
+
+def compile_rules(rules, outputs, services):
+    """Compiles rules into a dispatch table {(source, pin, event): (action, ...)}.
+
+    A rule binds an input or motion event to commands of local outputs (by pin) or services:
+
+    {"when": {"input": 17, "event": "pressed"}, "then": {"output": 22, "command": "pulse/3"}}
+    {"when": {"motion": 4}, "then": [{"service": "vstream", "seconds": 60},
+                                     {"output": 23, "pattern": {"morse": "HI"}}]}
+
+    Commands are the batch items executed by outputSub.Output and vstreamSub.VStream.
+    """
+    table = {}
+    for i, rule in enumerate(rules):
+        when = rule['when']
+        source = next((s for s in EVENTS if s in when), None)
+        if source is None:
+            raise ValueError('rule {}: "when" needs one of {}'.format(i, list(EVENTS)))
+        event = when.get('event', EVENTS[source][0])
+        if event not in EVENTS[source]:
+            raise ValueError('rule {}: unknown {} event {}'.format(i, source, event))
+        then = rule['then'] if isinstance(rule['then'], list) else [rule['then']]
+        actions = []
+        for item in then:
+            if 'output' in item:
+                handler = outputs.get(item['output'])
+            elif 'service' in item:
+                handler = services.get(item['service'])
+                if 'seconds' in item:
+                    item = dict(item, command='pulse/{}'.format(int(item['seconds'])))
+            else:
+                raise ValueError('rule {}: "then" needs an output or a service'.format(i))
+            if handler is None:
+                raise ValueError('rule {}: unknown target {}'.format(i, item.get('output', item.get('service'))))
+            actions.append(functools.partial(handler.execute, item))
+        key = (source, when[source], event)
+        table[key] = table.get(key, ()) + tuple(actions)
+    return table
+
+
+class Rules:
+    """Runs the local actions of device events without a cloud round trip.
+
+    bind() wraps an event handler: the actions of the event run first, in the thread of the event,
+    then the handler (which publishes the event) is queued to one telemetry thread so the
+    publish never delays the outputs. Arguments of the event, like an edge timestamp, are passed on.
+    """
+
+    def __init__(self, rules, outputs, services):
+        self.table = compile_rules(rules, outputs, services)
+        self._telemetry = ThreadPoolExecutor(1, thread_name_prefix='telemetry')
+        self._logger = logging.getLogger(__name__)
+
+    def bind(self, source, pin, event, handler):
+        """Returns the callback for an event, handler itself when no rule uses the event"""
+        actions = self.table.get((source, pin, event))
+        if not actions:
+            return handler
+        latency = iot.metrics.histogram('rule_seconds', source=source)
+
+        def fire(*args):
+            start = time.perf_counter()
+            for action in actions:
+                try:
+                    action()
+                except Exception as err:
+                    self._logger.warning('{} {} {}: {}'.format(source, pin, event, err))
+            latency.observe(time.perf_counter() - start)
+            self._telemetry.submit(handler, *args).add_done_callback(reported)
+
+        def reported(future):
+            err = future.exception()
+            if err is not None:
+                self._logger.warning('{} {} {} handler: {}'.format(source, pin, event, err))
+        return fire
@@ -0,0 +1,182 @@
+import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+import iot
+
+GPIOMEM = '/dev/gpiomem'
+GPLEV0 = 0x34  # pin level registers of the BCM2835..BCM2711, pins 0-31 then 32-53
+GPIOMEM_SOCS = (b'brcm,bcm2835', b'brcm,bcm2836', b'brcm,bcm2837', b'brcm,bcm2711')
+
+
+class PinReader:
+    """Reads the pin levels through gpiozero, one call per pin"""
+
+    def __init__(self):
+        self.devices = []
+
+    def add(self, pin, pull_up=False):
+        self.devices.append(iot.load('gpiozero').DigitalInputDevice(pin, pull_up=pull_up))
+
+    def read(self):
+        return [device.pin.state for device in self.devices]
+
+
+class GpiomemReader(PinReader):
+    """Reads the levels of all pins with one register read of /dev/gpiomem (Pi 1 to 4).
+
+    The pins are still claimed through gpiozero, which sets their function and pull.
+    """
+
+    def __init__(self, path=GPIOMEM, root='/'):
+        super().__init__()
+        with open(os.path.join(root, 'proc/device-tree/compatible'), 'rb') as f:
+            if not any(soc in f.read() for soc in GPIOMEM_SOCS):
+                raise OSError('no BCM283x GPIO registers')
+        fd = os.open(path, os.O_RDONLY | os.O_SYNC)
+        try:
+            self._mem = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        self._registers = memoryview(self._mem).cast('I')  # aligned 32 bit reads
+        self.pins = []
+
+    def add(self, pin, pull_up=False):
+        super().add(pin, pull_up)
+        self.pins.append(pin)
+
+    def read(self):
+        levels = (self._registers[GPLEV0 // 4], self._registers[GPLEV0 // 4 + 1])
+        return [(levels[pin >> 5] >> (pin & 31)) & 1 for pin in self.pins]
+
+
+def default_reader():
+    try:
+        return GpiomemReader()
+    except (OSError, ValueError):
+        return PinReader()
+
+
+class Channel:
+    """A sampled input with the callbacks and state of a gpiozero MotionSensor"""
+
+    def __init__(self, pin, queue_len=1, threshold=0.5, pull_up=False):
+        self.pin = pin
+        self.queue_len = queue_len
+        self.threshold = threshold
+        self.pull_up = pull_up
+        self.is_active = False
+        self.when_motion = None
+        self.when_no_motion = None
+
+    @property
+    def motion_detected(self):
+        return self.is_active
+
+
+class Sampler:
+    """Samples many inputs at one shared rate from a single thread.
+
+    Every tick reads all pins, pushes the levels into a ring buffer and updates the rolling
+    means of all channels at once (with NumPy when it is installed). Channels whose mean crosses
+    their threshold fire when_motion / when_no_motion, replacing the thread gpiozero runs per
+    MotionSensor.
+    """
+
+    def __init__(self, sample_rate=100, reader=None):
+        try:
+            self.numpy = iot.load('numpy')
+        except ImportError:
+            self.numpy = None
+        self.sample_rate = sample_rate
+        self.reader = reader if reader is not None else default_reader()
+        self.channels = []
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+
+    def add(self, pin, queue_len=1, threshold=0.5, pull_up=False):
+        """Samples pin, returns the Channel to set callbacks on"""
+        channel = Channel(pin, queue_len, threshold, pull_up)
+        with self._lock:
+            self.reader.add(pin, pull_up)
+            self.channels.append(channel)
+            self._reset()
+        return channel
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _reset(self):
+        n = len(self.channels)
+        self._window = max(channel.queue_len for channel in self.channels)
+        self._tick = 0
+        if self.numpy is not None:
+            np = self.numpy
+            self._buffer = np.zeros((self._window, n), np.int8)
+            self._sums = np.zeros(n, np.int32)
+            self._lens = np.array([channel.queue_len for channel in self.channels], np.int32)
+            self._thresholds = np.array([channel.threshold for channel in self.channels])
+            self._inverted = np.array([channel.pull_up for channel in self.channels], np.int8)
+            self._columns = np.arange(n)
+            self._active = np.array([channel.is_active for channel in self.channels], bool)
+        else:
+            self._buffer = [array('b', [0] * n) for _ in range(self._window)]
+            self._sums = [0] * n
+
+    def sample(self):
+        """Takes one sample of every channel, returns the [(channel, active)] that changed state"""
+        levels = self.reader.read()
+        with self._lock:
+            if self.numpy is not None:
+                return self._sample_numpy(levels)
+            return self._sample_python(levels)
+
+    def _sample_numpy(self, levels):
+        np = self.numpy
+        levels = np.asarray(levels, np.int8) ^ self._inverted
+        old = self._buffer[(self._tick - self._lens) % self._window, self._columns]
+        self._sums += levels - old
+        self._buffer[self._tick % self._window] = levels
+        self._tick += 1
+        active = (self._sums > self._thresholds * self._lens) & (self._tick >= self._lens)
+        changed = np.flatnonzero(active != self._active)
+        self._active = active
+        for i in changed:
+            self.channels[i].is_active = bool(active[i])
+        return [(self.channels[i], bool(active[i])) for i in changed]
+
+    def _sample_python(self, levels):
+        row = self._buffer[self._tick % self._window]
+        changed = []
+        for i, channel in enumerate(self.channels):
+            level = levels[i] ^ channel.pull_up
+            self._sums[i] += level - self._buffer[(self._tick - channel.queue_len) % self._window][i]
+            row[i] = level
+            active = self._sums[i] > channel.threshold * channel.queue_len and self._tick >= channel.queue_len - 1
+            if active != channel.is_active:
+                channel.is_active = active
+                changed.append((channel, active))
+        self._tick += 1
+        return changed
+
+    def _run(self):
+        period = 1.0 / self.sample_rate
+        deadline = time.monotonic()
+        while True:
+            for channel, active in self.sample():
+                callback = channel.when_motion if active else channel.when_no_motion
+                if callback is not None:
+                    try:
+                        callback()
+                    except Exception as err:
+                        self._logger.error('pin {} {}'.format(channel.pin, err))
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()  # fell behind, don't try to catch up
@@ -0,0 +1,85 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Scheduler:
+    """Runs callbacks at deadlines from one thread that sleeps until the next deadline.
+
+    Every key has at most one deadline. Scheduling a key again replaces its deadline in
+    O(log n); the superseded heap entry is skipped when it comes up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}  # key -> (deadline, callback)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._logger = logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, delay, callback):
+        """Runs callback after delay seconds, replacing any deadline of key"""
+        deadline = time.monotonic() + delay
+        with self._cond:
+            self._deadlines[key] = (deadline, callback)
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            if len(self._heap) > 2 * len(self._deadlines) + 16:
+                self._compact()
+            if self._heap[0][2] == key:
+                self._cond.notify()
+
+    def extend(self, key, delay, callback):
+        """Schedules key unless it is already due later, returns True if the deadline moved"""
+        with self._cond:
+            entry = self._deadlines.get(key)
+            if entry is not None and entry[0] >= time.monotonic() + delay:
+                return False
+            self.schedule(key, delay, callback)
+            return True
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def remaining(self, key):
+        """Returns the seconds until key is due, None if it isn't scheduled"""
+        with self._cond:
+            entry = self._deadlines.get(key)
+            return None if entry is None else max(entry[0] - time.monotonic(), 0)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _compact(self):
+        self._heap = [(deadline, next(self._seq), key) for key, (deadline, _) in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    deadline, _, key = self._heap[0]
+                    entry = self._deadlines.get(key)
+                    if entry is not None and entry[0] == deadline:
+                        break
+                    heapq.heappop(self._heap)  # cancelled or rescheduled
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                _, callback = self._deadlines.pop(key)
+                self._cond.release()
+                try:
+                    callback()
+                except Exception as err:
+                    self._logger.error('{} {}'.format(key, err))
+                finally:
+                    self._cond.acquire()
@@ -0,0 +1,144 @@
+import glob
+import os
+import shutil
+import subprocess as sp
+
+VCGENCMD = '/opt/vc/bin/vcgencmd'
+
+# metric name -> provider factories, cheapest first
+PROVIDERS = {}
+
+
+def provider(metric):
+    """Registers a provider factory for a metric.
+
+    A factory takes the filesystem root and returns a function reading the metric, or raises
+    OSError/ValueError when its source isn't available on this device.
+    """
+    def decorator(factory):
+        PROVIDERS.setdefault(metric, []).append(factory)
+        return factory
+    return decorator
+
+
+class FileSource:
+    """Keeps a file open and re-reads it from the start with pread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self, size=4096):
+        return os.pread(self._fd, size, 0).decode('ascii')
+
+    def close(self):
+        os.close(self._fd)
+
+
+def vcgencmd(*args):
+    """Returns the output of a vcgencmd call, raises OSError when the binary is missing"""
+    path = shutil.which('vcgencmd') or VCGENCMD
+    if not os.path.exists(path):
+        raise OSError('vcgencmd not found')
+    try:
+        return sp.check_output([path] + list(args)).decode('ASCII').rstrip('\n')
+    except sp.CalledProcessError as ex:
+        raise OSError(ex)
+
+
+def vcgencmd_value(output, suffix=''):
+    """Parses 'name=value<suffix>' vcgencmd output"""
+    return output.split('=')[1].strip().rstrip(suffix)
+
+
+@provider('temperature')
+def thermal_zone(root):
+    zones = sorted(glob.glob(os.path.join(root, 'sys/class/thermal/thermal_zone*')))
+    for zone in zones:
+        # prefer the cpu zone, the first zone is the cpu on a Raspberry Pi
+        with open(os.path.join(zone, 'type')) as f:
+            if 'cpu' in f.read().lower():
+                zones.insert(0, zone)
+                break
+    if not zones:
+        raise OSError('no thermal zone')
+    source = FileSource(os.path.join(zones[0], 'temp'))
+    return lambda: int(source.read()) / 1000.0
+
+
+@provider('temperature')
+def vcgencmd_temperature(root):
+    vcgencmd('measure_temp')
+    return lambda: float(vcgencmd_value(vcgencmd('measure_temp'), '\'C'))
+
+
+@provider('throttled')
+def firmware_throttled(root):
+    source = FileSource(os.path.join(root, 'sys/devices/platform/soc/soc:firmware/get_throttled'))
+    return lambda: int(source.read(), 16)
+
+
+@provider('throttled')
+def vcgencmd_throttled(root):
+    vcgencmd('get_throttled')
+    return lambda: int(vcgencmd_value(vcgencmd('get_throttled')), 16)
+
+
+@provider('voltage')
+def vcgencmd_voltage(root):
+    vcgencmd('measure_volts', 'core')
+    return lambda: float(vcgencmd_value(vcgencmd('measure_volts', 'core'), 'V'))
+
+
+@provider('memory')
+def meminfo(root):
+    source = FileSource(os.path.join(root, 'proc/meminfo'))
+
+    def read():
+        """Returns available memory in megabytes"""
+        for line in source.read().splitlines():
+            if line.startswith('MemAvailable:'):
+                return int(int(line.split()[1]) / 1024)
+        return None
+    read()
+    return read
+
+
+@provider('disk')
+def statvfs(root):
+    os.statvfs(root)
+
+    def read():
+        """Returns used disk space in megabytes"""
+        st = os.statvfs(root)
+        return int((st.f_blocks - st.f_bfree) * st.f_frsize / (1024 * 1024))
+    return read
+
+
+class Sensors:
+    """Reads metrics from the cheapest provider available on this device"""
+
+    def __init__(self, root='/'):
+        self.root = root
+        self._readers = {}
+
+    def reader(self, metric):
+        if metric not in self._readers:
+            self._readers[metric] = None
+            for factory in PROVIDERS.get(metric, []):
+                try:
+                    self._readers[metric] = factory(self.root)
+                    break
+                except (OSError, ValueError):
+                    continue
+        return self._readers[metric]
+
+    def read(self, metric):
+        """Returns the current value of the metric, None when it can't be read"""
+        reader = self.reader(metric)
+        if reader is None:
+            return None
+        try:
+            return reader()
+        except (OSError, ValueError, IndexError):
+            return None
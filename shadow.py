@@ -0,0 +1,128 @@
+import json
+import logging
+import threading
+from iot import iot_thing_topic, iot_payload, metrics
+
+
+class Coalescer:
+    """Merges reported shadow keys per thing over a window and publishes them as one document"""
+
+    def __init__(self, client, window=0.2, qos=1):
+        self.client = client
+        self.window = window
+        self.qos = qos
+        self.merged = 0  # updates folded into a pending document
+        self.sent = 0  # shadow documents published
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def update(self, thing, doc):
+        if self.window <= 0:
+            self._publish(thing, doc)
+            return
+        with self._lock:
+            pending = self._pending.get(thing)
+            if pending is not None:
+                pending.update(doc)
+                self.merged += 1
+                metrics.counter('shadow_merged_total').inc()
+                return
+            self._pending[thing] = dict(doc)
+        timer = threading.Timer(self.window, self.flush, (thing,))
+        timer.daemon = True
+        timer.start()
+
+    def flush(self, thing):
+        with self._lock:
+            doc = self._pending.pop(thing, None)
+        if doc is not None:
+            self._publish(thing, doc)
+
+    def flush_all(self):
+        """Publishes every pending document now instead of at the end of its window"""
+        with self._lock:
+            things = list(self._pending)
+        for thing in things:
+            self.flush(thing)
+
+    def _publish(self, thing, doc):
+        self.client.publish(iot_thing_topic(thing), iot_payload('reported', doc), self.qos)
+        self.sent += 1
+        metrics.counter('shadow_sent_total').inc()
+        self._logger.debug('{} merged={} sent={}'.format(thing, self.merged, self.sent))
+
+    def stats(self):
+        return {'merged': self.merged, 'sent': self.sent}
+
+
+class Mirror:
+    """Local copy of a thing's shadow that drives outputs from the desired state.
+
+    Listens to update/delta and get/accepted, ignores documents older than the version it holds,
+    applies only the keys whose value differs from what the output was last set to, and reports
+    the applied values through a Coalescer so a burst of keys goes out as one update. A get is
+    requested when the connection comes (back) online.
+    """
+
+    def __init__(self, client, thing, outputs, coalescer=None):
+        self.client = client
+        self.thing = thing
+        self.outputs = outputs  # shadow key -> function applying a desired value
+        self.coalescer = coalescer if coalescer is not None else Coalescer(client)
+        self.version = 0
+        self.applied = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def subscribe(self):
+        self.client.subscribe(iot_thing_topic(self.thing, 'update/delta'), 1, self.deltaCallback)
+        self.client.subscribe(iot_thing_topic(self.thing, 'get/accepted'), 1, self.getCallback)
+        self.resync()
+
+    def resync(self):
+        """Requests the full document, whose delta is applied when it arrives"""
+        self.client.publish(iot_thing_topic(self.thing, 'get'), '', 1)
+
+    def deltaCallback(self, client, userdata, message):
+        try:
+            doc = json.loads(message.payload)
+        except ValueError as err:
+            self._logger.warning('invalid delta {}: {}'.format(message.payload, err))
+            return
+        self.apply(doc.get('state', {}), doc.get('version'))
+
+    def getCallback(self, client, userdata, message):
+        try:
+            doc = json.loads(message.payload)
+        except ValueError as err:
+            self._logger.warning('invalid shadow {}: {}'.format(message.payload, err))
+            return
+        self.apply(doc.get('state', {}).get('delta', {}), doc.get('version'))
+
+    def apply(self, desired, version=None):
+        """Applies the changed keys of a desired state, returns them"""
+        with self._lock:
+            if version is not None and version <= self.version:
+                return {}  # stale or already applied
+            changed = dict((key, value) for key, value in desired.items()
+                           if key in self.outputs and self.applied.get(key) != value)
+        failed = set()
+        for key, value in changed.items():
+            try:
+                self.outputs[key](value)
+            except Exception as err:
+                failed.add(key)
+                self._logger.warning('{} {}: {}'.format(key, value, err))
+        changed = dict((key, value) for key, value in changed.items() if key not in failed)
+        with self._lock:
+            self.applied.update(changed)
+            # with a failed key the version is kept, so a resync carrying the same version retries it
+            if version is not None and not failed:
+                self.version = max(self.version, version)
+        # the delta stays until reported, also for keys that were already applied; failed keys stay
+        # in the delta and are retried with the next delta or resync
+        reported = dict((key, value) for key, value in desired.items() if key in self.outputs and key not in failed)
+        if reported:
+            self.coalescer.update(self.thing, reported)
+        return changed
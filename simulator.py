@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Load tests the cloud side with a fleet of virtual things. Every thing runs the real handlers
+# (inputPub.Input, motionPub.Motion, pinfo.Telemetry, vstreamSub.VStream) on its own MQTT
+# connection, its device events arriving after the gaps of a stochastic profile instead of GPIO
+# edges. The things are spread over a process pool, each worker running its things on one
+# asyncio loop. Reports the achieved msg/s and the QoS 1 publish-ack latency:
+#
+# python simulator.py --host localhost --port 1883 --things motion=2000 --things input=2000 \
+#     --things pinfo=500 --things vstream=500 --profile input=storm:0.01:20:50 --duration 300
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import iot
+from benchmark import version
+from inputPub import Input
+from motionPub import Motion
+from pinfo import Telemetry
+from scheduler import Scheduler
+from vstreamSub import VStream
+import transport
+
+Kinds = ['input', 'motion', 'pinfo', 'vstream']
+DEFAULT_PROFILES = {'input': 'storm:0.01:10:20', 'motion': 'poisson:0.05', 'pinfo': 'periodic:60',
+                    'vstream': 'poisson:0.005'}
+
+
+class Poisson:
+    """Events at rate per second on average, with exponentially distributed gaps"""
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def delays(self, rng):
+        while True:
+            yield rng.expovariate(self.rate)
+
+
+class Storm:
+    """Storms of burst events at burst_rate per second, the storms arriving at rate per second"""
+
+    def __init__(self, rate, burst=10, burst_rate=20):
+        self.rate = rate
+        self.burst = int(burst)
+        self.burst_rate = burst_rate
+
+    def delays(self, rng):
+        while True:
+            yield rng.expovariate(self.rate)
+            for _ in range(self.burst - 1):
+                yield rng.expovariate(self.burst_rate)
+
+
+class Periodic:
+    """One event every interval seconds, give or take jitter times the interval"""
+
+    def __init__(self, interval, jitter=0.1):
+        self.interval = interval
+        self.jitter = jitter
+
+    def delays(self, rng):
+        while True:
+            yield self.interval * rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+Profiles = {'poisson': Poisson, 'storm': Storm, 'periodic': Periodic}
+
+
+def parse_profile(spec):
+    """Parses NAME[:PARAM...], e.g. poisson:0.05, storm:0.01:10:20 or periodic:60"""
+    name, *params = spec.split(':')
+    if name not in Profiles:
+        raise ValueError('unknown profile {}, must be one of {}'.format(name, list(Profiles)))
+    return Profiles[name](*(float(param) for param in params))
+
+
+def kind_count(s):
+    """Parses a KIND=N argument"""
+    kind, _, count = s.partition('=')
+    if kind not in Kinds:
+        raise argparse.ArgumentTypeError('unknown kind {}, must be one of {}'.format(kind, Kinds))
+    return kind, int(count)
+
+
+def kind_profile(s):
+    """Parses a KIND=PROFILE argument"""
+    kind, _, spec = s.partition('=')
+    if kind not in Kinds:
+        raise argparse.ArgumentTypeError('unknown kind {}, must be one of {}'.format(kind, Kinds))
+    try:
+        parse_profile(spec)
+    except (ValueError, TypeError) as err:
+        raise argparse.ArgumentTypeError(str(err))
+    return kind, spec
+
+
+class VirtualClient:
+    """AWSIoTMQTTClient style publish() for handlers called on the loop of an AsyncClient"""
+
+    def __init__(self, client, stats):
+        self.client = client
+        self.stats = stats
+        self._tasks = set()
+
+    def publish(self, topic, payload, QoS):
+        task = asyncio.ensure_future(self._publish(topic, payload, QoS))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _publish(self, topic, payload, qos):
+        try:
+            await self.client.publish(topic, payload, qos)
+            self.stats['messages'] += 1
+        except (ConnectionError, OSError):
+            self.stats['errors'] += 1
+
+
+class VirtualService:
+    """supervised.Supervised stand-in, the profile starts and stops it"""
+
+    def __init__(self, process):
+        self.process = process
+        self.supervisor = self
+        self.state = 'STOPPED'
+
+    def status(self):
+        return self.state
+
+    def start(self):
+        self.state = 'RUNNING'
+
+    def stop(self):
+        self.state = 'STOPPED'
+
+    def invalidate(self):
+        pass
+
+
+def virtual_properties(thing, rng):
+    """Returns a pinfo.get_properties stand-in whose metrics random walk"""
+    properties = {'hostname': thing, 'eth0': '10.0.0.1', 'hardware': 'Simulated', 'megabytesMemoryFree': 400,
+                  'megabytesDiskUsed': 2000, 'percentCPUUtilization': 10.0, 'cpuTemperature': 45.0}
+
+    def read():
+        properties['megabytesMemoryFree'] = max(properties['megabytesMemoryFree'] + rng.randint(-20, 20), 0)
+        properties['megabytesDiskUsed'] += rng.randint(0, 5)
+        properties['percentCPUUtilization'] = min(max(properties['percentCPUUtilization'] + rng.gauss(0, 5), 0), 100)
+        properties['cpuTemperature'] = round(properties['cpuTemperature'] + rng.gauss(0, 0.5), 1)
+        return dict(properties)
+    return read
+
+
+def build(kind, thing, client, rng, scheduler, prefix):
+    """Returns the event(timestamp) of a virtual thing and its (topic, qos, callback) subscription or None"""
+    topic = '{}/{}/{}'.format(prefix, thing, kind)
+    if kind == 'input':
+        handler = Input(client, thing, 'button', topic)
+        pressed = []
+
+        def event(timestamp):
+            if pressed:
+                pressed.pop()
+                handler.low(timestamp)
+            else:
+                pressed.append(True)
+                handler.high(timestamp)
+        return event, None
+    if kind == 'motion':
+        return Motion(client, thing, topic).motion, None
+    if kind == 'pinfo':
+        telemetry = Telemetry(client, thing, resync=10, properties=virtual_properties(thing, rng))
+        return lambda timestamp: telemetry.report(), None
+    service = VirtualService('vstream')
+    handler = VStream(client, service, thing, topic, scheduler)
+
+    def event(timestamp):
+        if service.state == 'RUNNING':
+            service.stop()
+        else:
+            service.start()
+        handler.check()
+    return event, ('{}/#'.format(topic), 1, handler.subscriptionCallback)
+
+
+def histogram_state(histogram):
+    return histogram.counts, histogram.count, histogram.sum, histogram.max
+
+
+def merge(histogram, state):
+    counts, count, total, maximum = state
+    histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+    histogram.count += count
+    histogram.sum += total
+    histogram.max = max(histogram.max, maximum)
+    return histogram
+
+
+def summary(histogram):
+    """Returns p50, p99 and max of a histogram as milliseconds"""
+    return {'p50_ms': histogram.quantile(0.5) * 1000, 'p99_ms': histogram.quantile(0.99) * 1000,
+            'max_ms': histogram.max * 1000}
+
+
+async def run_things(things, args, seed):
+    rng = random.Random(seed)
+    profiles = dict(DEFAULT_PROFILES, **dict(args.profile))
+    profiles = {kind: parse_profile(spec) for kind, spec in profiles.items()}
+    stats = {'connected': 0, 'connect_failures': 0, 'events': 0, 'messages': 0, 'errors': 0}
+    connect = iot.Histogram()
+    scheduler = Scheduler()  # vstream pulses of every thing of the worker
+    clients = []
+
+    async def run(kind, thing):
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        client = transport.AsyncClient(thing, args.keep_alive)
+        start = time.perf_counter()
+        try:
+            await client.connect(args.host, args.port)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            stats['connect_failures'] += 1
+            return
+        connect.observe(time.perf_counter() - start)
+        stats['connected'] += 1
+        clients.append(client)
+        event, subscription = build(kind, thing, VirtualClient(client, stats), rng, scheduler, args.prefix)
+        if subscription is not None:
+            await client.subscribe(*subscription)
+        for delay in profiles[kind].delays(rng):
+            await asyncio.sleep(delay)
+            stats['events'] += 1
+            event(time.time())
+
+    tasks = [asyncio.ensure_future(run(kind, thing)) for kind, thing in things]
+    await asyncio.sleep(args.ramp)
+    before = stats['messages']
+    await asyncio.sleep(args.duration)
+    stats['window_messages'] = stats['messages'] - before
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+    stats['connect'] = histogram_state(connect)
+    stats['ack'] = histogram_state(iot.metrics.histogram('ack_seconds'))
+    return stats
+
+
+def worker(things, args, seed):
+    iot.start_logging(args, logging.ERROR)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # one socket per thing
+    return asyncio.run(run_things(things, args, seed))
+
+
+def fake_broker():
+    """Starts a transport.FakeBroker on a background loop, returns its port"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='broker', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(transport.FakeBroker().start(), loop).result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost", help="MQTT broker under test (no TLS)")
+    parser.add_argument("--port", type=int, default=1883, help="Port of the broker")
+    parser.add_argument("--fake_broker", action="store_true", default=False,
+                        help="Run against an in-process transport.FakeBroker instead of --host")
+    parser.add_argument("--things", action="append", type=kind_count, default=[], metavar="KIND=N",
+                        help="Virtual things of a kind, repeat for several kinds: %s" % str(Kinds))
+    parser.add_argument("--profile", action="append", type=kind_profile, default=[], metavar="KIND=PROFILE",
+                        help="Event arrivals of a kind: poisson:RATE, storm:RATE[:BURST[:BURST_RATE]] or " +
+                             "periodic:INTERVAL[:JITTER], rates per second (defaults: %s)" % DEFAULT_PROFILES)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("-d", "--duration", type=float, default=60,
+                        help="Seconds measured once every thing connected")
+    parser.add_argument("--ramp", type=float, default=10, help="Seconds over which the things connect")
+    parser.add_argument("--keep_alive", type=int, default=60, help="MQTT keep alive interval in seconds")
+    parser.add_argument("--prefix", default="sim", help="Prefix of the thing names and topics")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the event arrivals")
+    parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout")
+    iot.add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.things:
+        parser.error("Add virtual things with --things KIND=N")
+        exit(2)
+
+    iot.start_logging(args, logging.ERROR)
+    if args.fake_broker:
+        args.host, args.port = '127.0.0.1', fake_broker()
+
+    counts = {}
+    for kind, count in args.things:
+        counts[kind] = counts.get(kind, 0) + count
+    things = [(kind, '{}-{}-{:05d}'.format(args.prefix, kind, i))
+              for kind, count in counts.items() for i in range(count)]
+    workers = max(min(args.workers, len(things)), 1)
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(worker, [things[i::workers] for i in range(workers)], [args] * workers,
+                                [args.seed + i for i in range(workers)]))
+
+    totals = {key: sum(result[key] for result in results)
+              for key in ('connected', 'connect_failures', 'events', 'messages', 'errors', 'window_messages')}
+    connect, ack = iot.Histogram(), iot.Histogram()
+    for result in results:
+        merge(connect, result['connect'])
+        merge(ack, result['ack'])
+    doc = json.dumps({'version': version(), 'python': platform.python_version(), 'machine': platform.machine(),
+                      'workers': workers, 'things': counts, 'duration': args.duration,
+                      'profiles': dict(DEFAULT_PROFILES, **dict(args.profile)),
+                      'connected': totals['connected'], 'connect_failures': totals['connect_failures'],
+                      'events': totals['events'], 'messages': totals['messages'], 'errors': totals['errors'],
+                      'messages_per_s': round(totals['window_messages'] / args.duration, 1),
+                      'connect': summary(connect), 'ack': summary(ack)}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(doc + '\n')
+    else:
+        print(doc)
@@ -0,0 +1,130 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import iot
+
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_COLLAPSE = 'collapse'
+SpoolPolicies = [POLICY_DROP_OLDEST, POLICY_COLLAPSE]
+SHADOW_UPDATE = '/shadow/update'
+
+
+def add_arguments(parser):
+    parser.add_argument("--spool", help="Spool file keeping unpublished messages on disk across restarts")
+    parser.add_argument("--spool_size", help="Maximum number of spooled messages", type=int, default=10000)
+    parser.add_argument("--spool_policy", help="Eviction when the spool is full: %s" % str(SpoolPolicies),
+                        default=POLICY_DROP_OLDEST)
+
+
+def validate_args(parser, args):
+    if args.spool_policy not in SpoolPolicies:
+        parser.error("Unknown --spool_policy option %s. Must be one of %s" % (args.spool_policy, str(SpoolPolicies)))
+        exit(2)
+
+
+def from_args(args):
+    """Returns the Spool selected on the command line, None without --spool"""
+    return Spool(args.spool, args.spool_size, args.spool_policy) if args.spool else None
+
+
+class Spool:
+    """Disk backed message queue (SQLite WAL) that survives restarts.
+
+    Behaves like the queue.Queue used by publisher.Publisher: get() hands out the oldest message
+    and task_done() removes it once published, so nothing is lost if the process dies in between.
+    When max_messages is reached the oldest messages are evicted; with the collapse policy shadow
+    updates are first merged into the pending update of the same thing.
+    """
+
+    def __init__(self, path, max_messages=10000, policy=POLICY_DROP_OLDEST):
+        if policy not in SpoolPolicies:
+            raise ValueError('Unknown spool policy {}. Must be one of {}'.format(policy, SpoolPolicies))
+        self.max_messages = max_messages
+        self.policy = policy
+        self.evicted = 0
+        self.collapsed = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, payload TEXT, qos INTEGER)')
+        self._count = self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+        self._head = None  # id of the message handed out by get()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._logger = logging.getLogger(__name__)
+        iot.metrics.gauge('spool_messages', fn=self.qsize)
+        iot.metrics.gauge('spool_evicted_total', fn=lambda: self.evicted)
+        iot.metrics.gauge('spool_collapsed_total', fn=lambda: self.collapsed)
+
+    @property
+    def unfinished_tasks(self):
+        return self._count
+
+    def qsize(self):
+        return self._count
+
+    def put_nowait(self, item):
+        topic, payload, qos = item
+        with self._lock:
+            if self.policy == POLICY_COLLAPSE and topic.endswith(SHADOW_UPDATE) and self._collapse(topic, payload):
+                self.collapsed += 1
+                return
+            if self._count >= self.max_messages:
+                self._evict(self._count - self.max_messages + 1)
+            self._db.execute('INSERT INTO spool (topic, payload, qos) VALUES (?, ?, ?)', (topic, payload, qos))
+            self._count += 1
+            self._ready.notify()
+
+    put = put_nowait
+
+    def _collapse(self, topic, payload):
+        row = self._db.execute('SELECT id, payload FROM spool WHERE topic = ? AND id != ? ORDER BY id DESC LIMIT 1',
+                               (topic, self._head or -1)).fetchone()
+        if row is None:
+            return False
+        try:
+            doc = json.loads(row[1])
+            for target, values in json.loads(payload)['state'].items():
+                doc['state'].setdefault(target, {}).update(values)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        self._db.execute('UPDATE spool SET payload = ? WHERE id = ?', (json.dumps(doc), row[0]))
+        return True
+
+    def _evict(self, n):
+        cursor = self._db.execute('DELETE FROM spool WHERE id IN '
+                                  '(SELECT id FROM spool WHERE id != ? ORDER BY id LIMIT ?)', (self._head or -1, n))
+        self._count -= cursor.rowcount
+        self.evicted += cursor.rowcount
+        self._logger.warning('spool full, evicted {} messages'.format(cursor.rowcount))
+
+    def get(self, block=True, timeout=None):
+        """Returns the oldest message without removing it, raises queue.Empty on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                row = self._db.execute('SELECT id, topic, payload, qos FROM spool ORDER BY id LIMIT 1').fetchone()
+                if row is not None:
+                    self._head = row[0]
+                    return row[1], row[2], row[3]
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self._ready.wait(remaining)
+
+    def task_done(self):
+        """Removes the message returned by the last get()"""
+        with self._lock:
+            if self._head is not None:
+                cursor = self._db.execute('DELETE FROM spool WHERE id = ?', (self._head,))
+                self._count -= cursor.rowcount
+                self._head = None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
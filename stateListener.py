@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+# supervisord event listener forwarding PROCESS_STATE events to the subscribers over a unix
+# datagram socket, so state changes are published as they happen instead of being polled:
+#
+# [eventlistener:stateListener]
+# command=/opt/slice/stateListener.py --socket /run/slice/events.sock
+# events=PROCESS_STATE
+
+import argparse
+import json
+import socket
+import sys
+
+STATE_EVENT = 'PROCESS_STATE_'
+
+
+def parse_tokens(line):
+    """Parses 'key:value key:value' supervisor event headers"""
+    return dict(token.split(':', 1) for token in line.split() if ':' in token)
+
+
+def forward(sock, path, header, payload):
+    if not header.get('eventname', '').startswith(STATE_EVENT):
+        return
+    body = parse_tokens(payload.split('\n', 1)[0])
+    event = {'process': body.get('processname'),
+             'group': body.get('groupname'),
+             'state': header['eventname'][len(STATE_EVENT):],
+             'from_state': body.get('from_state')}
+    try:
+        sock.sendto(json.dumps(event).encode('utf-8'), path)
+    except OSError:
+        pass  # no subscriber listening, it reads the state when it starts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", action="store", dest="socket", required=True,
+                        help="Unix datagram socket the subscribers listen on")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    while True:
+        sys.stdout.write('READY\n')
+        sys.stdout.flush()
+        header = parse_tokens(sys.stdin.readline())
+        payload = sys.stdin.read(int(header.get('len', 0)))
+        forward(sock, args.socket, header, payload)
+        sys.stdout.write('RESULT 2\nOK')
+        sys.stdout.flush()
@@ -1,38 +1,113 @@
-from xmlrpc.client import ServerProxy
+from xmlrpc.client import ServerProxy, Transport
+import json
 import logging
+import os
+import socket
+import threading
+import time
 
-LOG_FORMAT = '%(asctime)s %(filename)-15s %(funcName)-15s %(levelname)-8s %(message)s'
+import iot
+
+DEFAULT_PROXY = 'http://localhost:9001/RPC2'
+
+
+class TimeoutTransport(Transport):
+    """Keep-alive HTTP transport with a socket timeout"""
+
+    def __init__(self, timeout=5):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class Supervisor:
+    """Connection to supervisord shared by any number of Supervised processes.
+
+    The states of all processes are fetched with one getAllProcessInfo call and cached for ttl
+    seconds; starting or stopping a process invalidates the cache.
+    """
+
+    def __init__(self, proxy=DEFAULT_PROXY, timeout=5, ttl=1):
+        self._server = ServerProxy(proxy, transport=TimeoutTransport(timeout))
+        self._lock = threading.Lock()
+        self.ttl = ttl
+        self._states = {}
+        self._expires = 0
+
+    def call(self, method, *args):
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                return getattr(self._server.supervisor, method)(*args)
+        except Exception:
+            iot.metrics.counter('supervisor_rpc_errors_total', method=method).inc()
+            raise
+        finally:
+            iot.metrics.histogram('supervisor_rpc_seconds', method=method).observe(time.perf_counter() - start)
+
+    def states(self):
+        """Returns {process name: state name} of all processes"""
+        now = time.monotonic()
+        if now >= self._expires:
+            states = {}
+            for info in self.call('getAllProcessInfo'):
+                states[info['name']] = info['statename']
+                states['{}:{}'.format(info['group'], info['name'])] = info['statename']
+            self._states = states
+            self._expires = now + self.ttl
+        return self._states
+
+    def invalidate(self):
+        self._expires = 0
+
+
+def state_events(path):
+    """Yields the PROCESS_STATE events forwarded by stateListener.py to the unix socket path"""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    while True:
+        try:
+            yield json.loads(sock.recv(4096).decode('utf-8'))
+        except ValueError:
+            continue
 
 
 class Supervised:
 
-    def __init__(self, process, proxy='http://localhost:9001/RPC2'):
+    def __init__(self, process, proxy=DEFAULT_PROXY, timeout=5, ttl=1, supervisor=None):
         self.process = process
-        self._server = ServerProxy(proxy)
-        # Configure logging
-        logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+        self.supervisor = supervisor if supervisor is not None else Supervisor(proxy, timeout, ttl)
         self._logger = logging.getLogger(self.process)
-        stream_handler = logging.StreamHandler()
-        self._logger.addHandler(stream_handler)
 
     def status(self):
         try:
-            process = self._server.supervisor.getProcessInfo(self.process)
-            if 'statename' in process:
-                return process['statename']
+            states = self.supervisor.states()
+            if self.process in states:
+                return states[self.process]
             else:
+                self._logger.error("{} unknown process".format(self.process))
                 return None
         except Exception as e:
             self._logger.error("{} {}".format(self.process, e))
 
     def start(self):
         try:
-            self._server.supervisor.startProcess(self.process)
+            self.supervisor.call('startProcess', self.process)
         except Exception as e:
             self._logger.error("{} {}".format(self.process, e))
+        finally:
+            self.supervisor.invalidate()
 
     def stop(self):
         try:
-            self._server.supervisor.stopProcess(self.process)
+            self.supervisor.call('stopProcess', self.process)
         except Exception as e:
             self._logger.error("{} {}".format(self.process, e))
+        finally:
+            self.supervisor.invalidate()
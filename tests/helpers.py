@@ -0,0 +1,3 @@
+class NullOutput:
+    """Output device without hardware"""
+    value = 0
@@ -0,0 +1,69 @@
+import json
+
+import iot
+
+
+class Client:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, QoS):
+        self.published.append((topic, json.loads(payload)))
+
+
+class Target:
+
+    def __init__(self):
+        self.items = []
+
+    def execute(self, item):
+        self.items.append(item)
+
+
+def test_invalid_items_fail_alone():
+    client = Client()
+    target = Target()
+    batch = iot.Batch(client, 'home/commands', {'22': target})
+    results = batch.execute(json.dumps({'id': 7, 'commands': ['on', {'command': 'off'}]}))
+    assert [result['ok'] for result in results] == [False, True]
+    assert 'TypeError' in results[0]['error']
+    assert target.items == [{'command': 'off'}]
+    assert client.published == [('home/commands-reply', {'id': 7, 'results': results})]
+
+
+class CallbackThreadClient(Client):
+    """Handles acks on the thread that dispatches messages, like the SDK: a QoS 1 publish from a
+    subscription callback can't be acked and times out"""
+
+    def __init__(self):
+        super().__init__()
+        self.dispatching = False
+
+    def dispatch(self, callback, payload):
+        self.dispatching = True
+        try:
+            callback(self, None, type('Message', (), {'payload': payload}))
+        finally:
+            self.dispatching = False
+
+    def publish(self, topic, payload, QoS):
+        if QoS and self.dispatching:
+            raise TimeoutError('publish timed out')
+        super().publish(topic, payload, QoS)
+
+
+def test_reply_from_callback_thread():
+    client = CallbackThreadClient()
+    target = Target()
+    batch = iot.Batch(client, 'home/commands', {'22': target})
+    client.dispatch(batch.subscriptionCallback, json.dumps([{'command': 'on'}]))
+    assert target.items == [{'command': 'on'}]
+    assert client.published == [('home/commands-reply', {'results': [{'target': None, 'command': 'on', 'ok': True}]})]
+
+
+def test_failed_reply_leaves_dispatch_running():
+    client = CallbackThreadClient()
+    batch = iot.Batch(client, 'home/commands', {'22': Target()}, qos=1)
+    client.dispatch(batch.subscriptionCallback, json.dumps([{'command': 'on'}]))
+    assert client.published == []
@@ -0,0 +1,71 @@
+import time
+
+import failover
+import transport
+from test_transport import Broker, wait_for
+
+
+def test_failover_and_failback():
+    preferred, backup = Broker(), Broker()
+    clients = []
+
+    def factory(host, port):
+        client = transport.ThreadedClient('device')
+        client.configureEndpoint(host, port)
+        clients.append(client)
+        return client
+
+    manager = failover.ConnectionManager([failover.Endpoint('127.0.0.1', preferred.port, 100),
+                                          failover.Endpoint('127.0.0.1', backup.port, 1)],
+                                         factory, probe_interval=0.2)
+    received = []
+    online = []
+    manager.onOnline = lambda: online.append(manager.active.port)
+    manager.subscribe('cmd/#', 1, lambda client, userdata, message: received.append(message.topic))
+    manager.connect()
+    assert manager.active.port == preferred.port
+
+    preferred.stop()
+    assert wait_for(lambda: manager.client is not None and manager.active.port == backup.port)
+    manager.publish('cmd/1', 'x', 1)
+    assert wait_for(lambda: received == ['cmd/1'])
+
+    preferred.start()  # the prober moves back to the preferred endpoint
+    assert wait_for(lambda: manager.active.port == preferred.port)
+    time.sleep(1.5)  # a replaced client reconnecting on its own would be back by now
+    manager.publish('cmd/2', 'x', 1)
+    assert wait_for(lambda: received == ['cmd/1', 'cmd/2'])
+    time.sleep(0.2)
+    assert received == ['cmd/1', 'cmd/2']
+    assert online == [preferred.port, backup.port, preferred.port]
+    assert [client.client.connected for client in clients].count(True) == 1
+
+    replaced = clients[1]  # callbacks of a replaced client are ignored
+    replaced._loop.call_soon_threadsafe(replaced.client._dispatch, transport.Message('cmd/3', b'x'))
+    replaced.onOnline()
+    time.sleep(0.1)
+    assert received == ['cmd/1', 'cmd/2']
+    assert len(online) == 3
+    manager.disconnect()
+
+
+def test_probing_survives_reconnect():
+    preferred, backup = Broker(), Broker()
+    preferred.stop()
+
+    def factory(host, port):
+        client = transport.ThreadedClient('device')
+        client.configureEndpoint(host, port)
+        return client
+
+    manager = failover.ConnectionManager([failover.Endpoint('127.0.0.1', preferred.port, 100),
+                                          failover.Endpoint('127.0.0.1', backup.port, 1)],
+                                         factory, probe_interval=0.2)
+    manager.connect()
+    manager.disconnect()
+    time.sleep(0.5)
+    manager.connect()
+    assert manager.active.port == backup.port
+    preferred.start()
+    assert wait_for(lambda: manager.active is not None and manager.active.port == preferred.port)
+    manager.disconnect()
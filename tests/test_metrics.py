@@ -0,0 +1,23 @@
+import iot
+
+
+def test_render_one_type_per_family():
+    metrics = iot.Metrics()
+    metrics.counter('batch_commands_total', ok=True).inc()
+    metrics.counter('batch_commands_total', ok=False).inc(2)
+    metrics.histogram('publish_seconds', qos=0).observe(0.01)
+    metrics.histogram('publish_seconds', qos=1).observe(0.1)
+    text = metrics.render()
+    assert text.count('# TYPE batch_commands_total counter') == 1
+    assert text.count('# TYPE publish_seconds histogram') == 1
+    assert 'batch_commands_total{ok="False"} 2' in text
+    assert 'publish_seconds_count{qos="1"} 1' in text
+
+
+def test_render_skips_unknown_gauges():
+    metrics = iot.Metrics()
+    metrics.gauge('cpu_temperature', fn=lambda: None)
+    metrics.gauge('queue', fn=lambda: 3)
+    text = metrics.render()
+    assert 'cpu_temperature' not in text
+    assert text == '# TYPE queue gauge\nqueue 3\n'
@@ -0,0 +1,41 @@
+import threading
+
+from occupancy import Sessionizer
+
+
+class Client:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, QoS):
+        self.published.append(topic)
+
+
+class Scheduler:
+    """Records deadlines; the first cancel lets a motion event race the close that cancels"""
+
+    def __init__(self):
+        self.scheduled = {}
+        self.racer = None
+
+    def schedule(self, key, delay, callback):
+        self.scheduled[key] = callback
+
+    def cancel(self, key):
+        if self.racer is not None:
+            racer, self.racer = self.racer, None
+            racer.start()
+            racer.join(0.2)
+        self.scheduled.pop(key, None)
+
+
+def test_motion_during_close_keeps_its_session():
+    scheduler = Scheduler()
+    sessions = Sessionizer(Client(), 'thing', 'home/motion', hold_off=30, scheduler=scheduler)
+    sessions.motion(100.0)
+    racer = scheduler.racer = threading.Thread(target=sessions.motion, args=(101.0,))
+    sessions.close()
+    racer.join(1)
+    assert sessions.session is not None
+    assert 'session:home/motion' in scheduler.scheduled
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from patterns import Pattern, Sequencer
+from scheduler import Scheduler
+
+
+@pytest.fixture
+def pin_factory():
+    gpiozero = pytest.importorskip('gpiozero')
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+    previous, gpiozero.Device.pin_factory = gpiozero.Device.pin_factory, MockFactory(pin_class=MockPWMPin)
+    yield gpiozero
+    gpiozero.Device.pin_factory.reset()
+    gpiozero.Device.pin_factory = previous
+
+
+def test_repeated_patterns_need_a_duration():
+    with pytest.raises(ValueError):
+        Pattern.from_doc({'steps': [[1, 0]], 'repeat': 1e9})
+    with pytest.raises(ValueError):
+        Pattern.from_doc({'steps': [[1, 0]], 'repeat': 0})
+    assert list(Pattern.from_doc({'steps': [[1, 0]]})) == [(1, 0), (0, 0)]
+
+
+def test_pattern_preempts_the_playing_one(pin_factory):
+    led = pin_factory.PWMOutputDevice(17)
+    sequencer = Sequencer()
+    sequencer.play(led, Pattern([(1, 0.2), (0.5, 0.2)], then=0.25))
+    assert led.value == 1
+    sequencer.play(led, Pattern([(0.75, 0.05)], then=0))
+    assert led.value == 0.75
+    time.sleep(0.1)
+    assert led.value == 0 and not sequencer.playing(led)
+    time.sleep(0.5)  # the steps of the preempted pattern never run
+    assert led.value == 0
+    assert [state for _, state in led.pin.states] == [0, 1, 0.75, 0]
+
+
+def test_patterns_play_to_the_end(pin_factory):
+    led = pin_factory.PWMOutputDevice(18)
+    sequencer = Sequencer()
+    sequencer.play(led, Pattern.blink(0.02, 0.02, 2))
+    time.sleep(0.3)
+    assert [state for _, state in led.pin.states] == [0, 1, 0, 1, 0]
+    assert not sequencer.playing(led)
+
+
+def test_extend_only_moves_deadlines_later():
+    scheduler = Scheduler()
+    assert scheduler.extend('k', 10, lambda: None)
+    assert not scheduler.extend('k', 5, lambda: None)
+    assert 9 < scheduler.remaining('k') <= 10
+    assert scheduler.extend('k', 20, lambda: None)
+    assert 19 < scheduler.remaining('k') <= 20
+
+
+def test_cancelled_deadlines_do_not_run():
+    scheduler = Scheduler()
+    ran = threading.Event()
+    scheduler.schedule('k', 0.05, ran.set)
+    scheduler.cancel('k')
+    assert scheduler.remaining('k') is None
+    assert not ran.wait(0.2)
+    scheduler.extend('k', 0.05, ran.set)
+    assert ran.wait(1) and len(scheduler) == 0
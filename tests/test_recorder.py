@@ -0,0 +1,25 @@
+import time
+
+import recorder
+
+
+def test_records_are_flushed_without_further_traffic(tmp_path):
+    rec = recorder.Recorder(str(tmp_path), flush_interval=0.05)
+    rec.record(True, 'home/relay/on', b'', 1)
+    rec.record(False, 'home/relay', '{"relay": 1}')
+    time.sleep(0.2)
+    records = list(recorder.read(str(tmp_path)))
+    assert [(r.direction, r.topic, bytes(r.payload)) for r in records] == [
+        ('in', 'home/relay/on', b''), ('out', 'home/relay', b'{"relay": 1}')]
+    rec.close()
+    rec.close()
+    rec.record(True, 'home/relay/off', b'')  # ignored once closed
+
+
+def test_output_topic_follows_the_output_routes():
+    assert recorder.output_topic('home/relay/off/now') == 'home/relay'
+    assert recorder.output_topic('home/relay/pulse/5') == 'home/relay'
+    assert recorder.output_topic('home/relay/pulse/5/extra') == 'home/relay'
+    assert recorder.output_topic('home/relay/pattern') == 'home/relay'
+    assert recorder.output_topic('home/relay/on') == 'home/relay'
+    assert recorder.output_topic('home/relay/batch') is None
@@ -0,0 +1,28 @@
+import pytest
+
+import iot
+from helpers import NullOutput
+from outputSub import Output
+
+
+def test_hash_must_be_the_last_level():
+    router = iot.Router('a')
+    with pytest.raises(ValueError):
+        router.add('#/b', print)
+    router.add('x/#', lambda rest: rest)
+    assert router.match('a/x/1/2')[1] == [['1', '2']]
+    assert router.match('a/x')[1] == [[]]
+
+
+def test_output_ignores_extra_levels():
+    output = Output(NullOutput(), 'home/relay')
+    for topic, value in [('home/relay/on', 1), ('home/relay/off/now', 0), ('home/relay/on/x', 1)]:
+        assert output.router.dispatch(topic)
+        assert output.output.value == value
+    counts = []
+    output.device = counts.append
+    assert output.router.dispatch('home/relay/pulse/5/extra')
+    assert output.router.dispatch('home/relay/pulse/3')
+    assert output.router.dispatch('home/relay/blink')
+    assert not output.router.dispatch('home/relay/pulse/x')
+    assert counts == [5, 3, 1]
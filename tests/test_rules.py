@@ -0,0 +1,26 @@
+import logging
+
+from rules import Rules
+
+
+class Target:
+
+    def __init__(self):
+        self.items = []
+
+    def execute(self, item):
+        self.items.append(item)
+
+
+def test_handler_errors_are_logged(caplog):
+    target = Target()
+    rules = Rules([{'when': {'input': 17}, 'then': {'output': 22, 'command': 'on'}}], {22: target}, {})
+
+    def handler(timestamp=None):
+        raise ConnectionError('publish timed out')
+    fire = rules.bind('input', 17, 'pressed', handler)
+    with caplog.at_level(logging.WARNING, logger='rules'):
+        fire(1.5)
+        rules._telemetry.shutdown(wait=True)
+    assert target.items == [{'output': 22, 'command': 'on'}]
+    assert 'input 17 pressed handler: publish timed out' in caplog.text
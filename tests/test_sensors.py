@@ -0,0 +1,43 @@
+import os
+
+import sensors
+
+
+def write(root, path, content):
+    path = os.path.join(str(root), path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_thermal_zone_prefers_the_cpu_zone(tmp_path):
+    write(tmp_path, 'sys/class/thermal/thermal_zone0/type', 'x86_pkg_temp\n')
+    write(tmp_path, 'sys/class/thermal/thermal_zone0/temp', '70000\n')
+    write(tmp_path, 'sys/class/thermal/thermal_zone1/type', 'cpu-thermal\n')
+    write(tmp_path, 'sys/class/thermal/thermal_zone1/temp', '45678\n')
+    assert sensors.Sensors(str(tmp_path)).read('temperature') == 45.678
+
+
+def test_file_source_rereads_the_open_file(tmp_path):
+    write(tmp_path, 'sys/devices/platform/soc/soc:firmware/get_throttled', '0x0\n')
+    readings = sensors.Sensors(str(tmp_path))
+    assert readings.read('throttled') == 0
+    write(tmp_path, 'sys/devices/platform/soc/soc:firmware/get_throttled', '0x50005\n')
+    assert readings.read('throttled') == 0x50005
+
+
+def no_vcgencmd(*args):
+    raise OSError('vcgencmd not found')
+
+
+def test_meminfo_and_missing_sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(sensors, 'vcgencmd', no_vcgencmd)
+    write(tmp_path, 'proc/meminfo', 'MemTotal:  1024000 kB\nMemAvailable:  512000 kB\n')
+    readings = sensors.Sensors(str(tmp_path))
+    assert readings.read('memory') == 500
+    assert readings.read('temperature') is None
+    assert readings.read('unknown') is None
+
+
+def test_statvfs_reads_the_root(tmp_path):
+    assert isinstance(sensors.Sensors(str(tmp_path)).read('disk'), int)
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from helpers import NullOutput
+from outputSub import Output
+from shadow import Coalescer, Mirror
+
+
+class Client:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, QoS):
+        self.published.append((topic, json.loads(payload) if payload else None))
+
+    def subscribe(self, topic, QoS, callback):
+        pass
+
+
+class Message:
+
+    def __init__(self, payload):
+        self.topic = '$aws/things/pi/shadow/update/delta'
+        self.payload = payload
+
+
+def fail(value):
+    raise ValueError('broken')
+
+
+def test_failed_keys_are_not_reported_and_retried():
+    client = Client()
+    set_values = []
+    mirror = Mirror(client, 'pi', {'relay': set_values.append, 'bad': fail}, Coalescer(client, window=0))
+    assert mirror.apply({'relay': 'on', 'bad': 1}, 1) == {'relay': 'on'}
+    assert client.published[-1][1] == {'state': {'reported': {'relay': 'on'}}}
+    mirror.outputs['bad'] = set_values.append
+    assert mirror.apply({'relay': 'on', 'bad': 1}, 2) == {'bad': 1}
+    assert set_values == ['on', 1]
+    assert client.published[-1][1] == {'state': {'reported': {'relay': 'on', 'bad': 1}}}
+
+
+def test_invalid_payload_is_ignored():
+    client = Client()
+    mirror = Mirror(client, 'pi', {'relay': fail}, Coalescer(client, window=0))
+    mirror.deltaCallback(None, None, Message(b'{not json'))
+    mirror.getCallback(None, None, Message(b''))
+    assert mirror.version == 0
+
+
+def test_output_rejects_unknown_values():
+    output = Output(NullOutput(), 'home/relay')
+    output.set('on')
+    assert output.output.value == 1
+    with pytest.raises(ValueError):
+        output.set('toggle')
+    assert output.output.value == 1
+
+
+def test_flush_all_publishes_open_windows():
+    client = Client()
+    shadow = Coalescer(client, window=60)
+    shadow.update('pi', {'a': 1})
+    shadow.update('pi', {'b': 2})
+    shadow.update('zero', {'a': 0})
+    shadow.flush_all()
+    assert shadow.stats() == {'merged': 1, 'sent': 2}
+    assert client.published[0][1] == {'state': {'reported': {'a': 1, 'b': 2}}}
+
+
+def test_resync_with_the_same_version_retries_failed_keys():
+    client = Client()
+    set_values = []
+    mirror = Mirror(client, 'pi', {'relay': set_values.append, 'bad': fail}, Coalescer(client, window=0))
+    mirror.apply({'relay': 'on', 'bad': 1}, 5)
+    mirror.outputs['bad'] = set_values.append
+    assert mirror.apply({'relay': 'on', 'bad': 1}, 5) == {'bad': 1}
+    assert set_values == ['on', 1]
+    assert mirror.apply({'relay': 'on', 'bad': 1}, 5) == {}
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import transport
+
+
+class Broker:
+    """FakeBroker on a background loop that can be stopped and restarted on the same port"""
+
+    def __init__(self, port=0):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.broker = None
+        self.port = self.start(port)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(5)
+
+    def start(self, port=None):
+        self.broker = transport.FakeBroker()
+        return self.run(self.broker.start(port=self.port if port is None else port))
+
+    def stop(self):
+        self.run(self.broker.stop())
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_disconnect_stops_reconnecting():
+    broker = Broker()
+    client = transport.ThreadedClient('t')
+    client.configureEndpoint('127.0.0.1', broker.port)
+    client.connect()
+    broker.stop()
+    assert wait_for(lambda: not client.client.connected)
+    client.disconnect()
+    broker.start()
+    time.sleep(1.5)  # the first reconnect attempt is due after 1s
+    assert not client.client.connected
+    assert client.client._reconnecting is None
+
+
+def test_reconnects_after_broker_restart():
+    broker = Broker()
+    client = transport.ThreadedClient('t')
+    client.configureEndpoint('127.0.0.1', broker.port)
+    client.connect()
+    broker.stop()
+    assert wait_for(lambda: not client.client.connected)
+    broker.start()
+    assert wait_for(lambda: client.client.connected, 3)
+    client.disconnect()
+
+
+def test_half_open_connection_is_lost():
+    async def silent(reader, writer):
+        await reader.read(100)
+        writer.write(transport.encode_packet(transport.CONNACK, 0, bytes([0, 0])))
+        await asyncio.sleep(10)  # never answers PINGREQ
+
+    async def run():
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        client = transport.AsyncClient('t', keep_alive=1, auto_reconnect=False)
+        await client.connect('127.0.0.1', server.sockets[0].getsockname()[1])
+        await asyncio.sleep(2)
+        connected = client.connected
+        server.close()
+        return connected
+    assert not asyncio.run(run())
@@ -0,0 +1,440 @@
+import asyncio
+import concurrent.futures
+import logging
+import ssl
+import struct
+import threading
+import time
+
+import iot
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class Message:
+    """Received message, shaped like the messages of AWSIoTMQTTClient callbacks"""
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+def topic_matches(pattern, topic):
+    """Returns True if the topic matches the subscription pattern ('+' and '#' wildcards)"""
+    pattern_levels = pattern.split('/')
+    levels = topic.split('/')
+    for i, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(levels) == len(pattern_levels)
+
+
+def encode_string(s):
+    data = s.encode('utf-8') if isinstance(s, str) else s
+    return struct.pack('!H', len(data)) + data
+
+
+def decode_string(data, offset):
+    length, = struct.unpack_from('!H', data, offset)
+    return data[offset + 2:offset + 2 + length].decode('utf-8'), offset + 2 + length
+
+
+def encode_packet(packet_type, flags, body=b''):
+    header = bytearray([packet_type << 4 | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+async def read_packet(reader):
+    """Returns (packet type, flags, body) of the next packet"""
+    first = (await reader.readexactly(1))[0]
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b''
+    return first >> 4, first & 0x0f, body
+
+
+def encode_publish(topic, payload, qos=0, packet_id=0, retain=False):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    body = encode_string(topic) + (struct.pack('!H', packet_id) if qos else b'') + payload
+    return encode_packet(PUBLISH, qos << 1 | int(retain), body)
+
+
+def decode_publish(flags, body):
+    """Returns (message, packet id) of a PUBLISH body"""
+    qos = (flags >> 1) & 0x03
+    topic, offset = decode_string(body, 0)
+    packet_id = 0
+    if qos:
+        packet_id, = struct.unpack_from('!H', body, offset)
+        offset += 2
+    return Message(topic, body[offset:], qos, bool(flags & 0x01)), packet_id
+
+
+class AsyncClient:
+    """asyncio MQTT 3.1.1 client.
+
+    publish() of QoS 1 messages returns once the broker acknowledged them; at most max_inflight
+    acknowledgements are awaited at a time, further publishers wait, which gives backpressure.
+    Cancelling a publish drops its acknowledgement. Subscription callbacks are called on the
+    event loop with (client, userdata, message) like AWSIoTMQTTClient callbacks; callbacks
+    returning a coroutine are run as tasks.
+    """
+
+    def __init__(self, client_id='', keep_alive=30, max_inflight=20, auto_reconnect=True):
+        self.client_id = client_id
+        self.keep_alive = keep_alive
+        self.max_inflight = max_inflight
+        self.auto_reconnect = auto_reconnect
+        self.connected = False
+        self.onOnline = None
+        self.onOffline = None
+        self._endpoint = None
+        self._reader = None
+        self._writer = None
+        self._inflight = None
+        self._pending = {}
+        self._subscriptions = []
+        self._packet_id = 0
+        self._tasks = []
+        self._reconnecting = None
+        self._received = 0  # monotonic time of the last packet from the broker
+        self._logger = logging.getLogger(__name__)
+
+    async def connect(self, host, port, ssl_context=None, timeout=10):
+        self._endpoint = (host, port, ssl_context, timeout)
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context), timeout)
+        body = encode_string('MQTT') + bytes([4, 0x02]) + struct.pack('!H', self.keep_alive) + \
+            encode_string(self.client_id)
+        self._writer.write(encode_packet(CONNECT, 0, body))
+        packet_type, _, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        if packet_type != CONNACK or body[1] != 0:
+            self._writer.close()
+            raise ConnectionError('connection refused: {}'.format(body[1] if len(body) > 1 else packet_type))
+        self.connected = True
+        self._received = time.monotonic()
+        self._tasks = [asyncio.ensure_future(self._read_loop())]
+        if self.keep_alive:
+            self._tasks.append(asyncio.ensure_future(self._ping_loop()))
+        if self.onOnline is not None:
+            self.onOnline()
+
+    async def disconnect(self):
+        self.auto_reconnect = False
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            try:
+                if self.connected:
+                    self._writer.write(encode_packet(DISCONNECT, 0))
+                    await self._writer.drain()
+            except (ConnectionError, OSError):
+                pass  # connection already gone
+            finally:
+                self._writer.close()
+        self.connected = False
+
+    def _next_packet_id(self):
+        self._packet_id = self._packet_id % 65535 + 1
+        return self._packet_id
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        if not self.connected:
+            raise ConnectionError('not connected')
+        if qos == 0:
+            self._writer.write(encode_publish(topic, payload, 0, retain=retain))
+            await self._writer.drain()
+            return
+        async with self._inflight:
+            packet_id = self._next_packet_id()
+            ack = asyncio.get_event_loop().create_future()
+            self._pending[packet_id] = ack
+            start = time.perf_counter()
+            try:
+                self._writer.write(encode_publish(topic, payload, 1, packet_id, retain))
+                await self._writer.drain()
+                await ack
+                iot.metrics.histogram('ack_seconds').observe(time.perf_counter() - start)
+            finally:
+                self._pending.pop(packet_id, None)
+
+    async def subscribe(self, topic, qos, callback):
+        self._subscriptions.append((topic, qos, callback))
+        await self._subscribe(topic, qos)
+
+    async def _subscribe(self, topic, qos):
+        packet_id = self._next_packet_id()
+        ack = asyncio.get_event_loop().create_future()
+        self._pending[packet_id] = ack
+        try:
+            self._writer.write(encode_packet(SUBSCRIBE, 0x02,
+                                             struct.pack('!H', packet_id) + encode_string(topic) + bytes([qos])))
+            await self._writer.drain()
+            codes = await ack
+        finally:
+            self._pending.pop(packet_id, None)
+        if codes[0] == 0x80:
+            raise ConnectionError('subscription to {} refused'.format(topic))
+
+    def _dispatch(self, message):
+        for topic, _, callback in self._subscriptions:
+            if topic_matches(topic, message.topic):
+                try:
+                    result = callback(self, None, message)
+                    if asyncio.iscoroutine(result):
+                        asyncio.ensure_future(result)
+                except Exception as err:
+                    self._logger.error('{} {}'.format(message.topic, err))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(self._reader)
+                self._received = time.monotonic()
+                if packet_type == PUBLISH:
+                    message, packet_id = decode_publish(flags, body)
+                    if message.qos:
+                        self._writer.write(encode_packet(PUBACK, 0, struct.pack('!H', packet_id)))
+                    self._dispatch(message)
+                elif packet_type in (PUBACK, SUBACK):
+                    packet_id, = struct.unpack_from('!H', body)
+                    ack = self._pending.get(packet_id)
+                    if ack is not None and not ack.done():
+                        ack.set_result(body[2:])
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as err:
+            self._lost(err)
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.keep_alive / 2)
+            if time.monotonic() - self._received > self.keep_alive:
+                # no PINGRESP to the previous PINGREQ: the connection is half open
+                self._writer.close()
+                self._lost(TimeoutError('no response from the broker in {}s'.format(self.keep_alive)))
+                return
+            self._writer.write(encode_packet(PINGREQ, 0))
+
+    def _lost(self, err):
+        self.connected = False
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        for ack in self._pending.values():
+            if not ack.done():
+                ack.set_exception(ConnectionError('connection lost'))
+        if self.onOffline is not None:
+            self.onOffline()
+        if self.auto_reconnect and self._reconnecting is None:
+            self._logger.warning('connection lost: {}'.format(err))
+            self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        try:
+            while not self.connected and self.auto_reconnect:
+                await asyncio.sleep(delay)
+                try:
+                    await self.connect(*self._endpoint)
+                    for topic, qos, _ in self._subscriptions:
+                        await self._subscribe(topic, qos)
+                except (asyncio.TimeoutError, ConnectionError, OSError) as err:
+                    self._logger.warning('reconnect failed: {}'.format(err))
+                    delay = min(delay * 2, 32)
+        finally:
+            self._reconnecting = None
+
+
+class ThreadedClient:
+    """AWSIoTMQTTClient compatible facade running an AsyncClient on a background event loop.
+
+    Lets the existing handlers (which call publish() and take (client, userdata, message)
+    callbacks) run on the asyncio transport unchanged. Callbacks run on the event loop thread.
+    """
+
+    def __init__(self, clientID='', useWebsocket=False):
+        if useWebsocket:
+            raise ValueError('the asyncio transport does not support WebSocket')
+        self.client = AsyncClient(clientID)
+        self._host = None
+        self._port = None
+        self._ssl = None
+        self._timeout = 10
+        self._operation_timeout = 5
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='transport', daemon=True)
+        self._thread.start()
+
+    @property
+    def onOnline(self):
+        return self.client.onOnline
+
+    @onOnline.setter
+    def onOnline(self, callback):
+        self.client.onOnline = callback
+
+    @property
+    def onOffline(self):
+        return self.client.onOffline
+
+    @onOffline.setter
+    def onOffline(self, callback):
+        self.client.onOffline = callback
+
+    def configureEndpoint(self, host, port):
+        self._host = host
+        self._port = port
+
+    def configureCredentials(self, rootCAPath, privateKeyPath=None, certificatePath=None):
+        self._ssl = ssl.create_default_context(cafile=rootCAPath)
+        if certificatePath:
+            self._ssl.load_cert_chain(certificatePath, privateKeyPath)
+        if self._port == 443:
+            self._ssl.set_alpn_protocols(['x-amzn-mqtt-ca'])
+
+    def configureConnectDisconnectTimeout(self, timeout):
+        self._timeout = timeout
+
+    def configureMQTTOperationTimeout(self, timeout):
+        self._operation_timeout = timeout
+
+    def configureAutoReconnectBackoffTime(self, *args):
+        pass  # AsyncClient backs off from 1 to 32 seconds
+
+    def configureOfflinePublishQueueing(self, *args):
+        pass  # publishing while offline raises, queue with publisher.Publisher
+
+    def configureDrainingFrequency(self, *args):
+        pass
+
+    def run(self, coroutine, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # don't leave the operation running on the loop
+            raise
+
+    def connect(self, keepAliveIntervalSecond=30):
+        self.client.keep_alive = keepAliveIntervalSecond
+        self.run(self.client.connect(self._host, self._port, self._ssl, self._timeout))
+        return True
+
+    def disconnect(self):
+        self.run(self.client.disconnect(), self._timeout)
+        return True
+
+    def publish(self, topic, payload, QoS):
+        if threading.current_thread() is self._thread:
+            # called from a subscription callback, the loop can't wait on itself
+            self._loop.create_task(self.client.publish(topic, payload, QoS)).add_done_callback(self._published)
+            return True
+        self.run(self.client.publish(topic, payload, QoS), self._operation_timeout)
+        return True
+
+    def subscribe(self, topic, QoS, callback):
+        self.run(self.client.subscribe(topic, QoS, callback), self._operation_timeout)
+        return True
+
+    @staticmethod
+    def _published(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning('publish failed: {}'.format(task.exception()))
+
+
+class FakeBroker:
+    """In-process MQTT broker for tests and benchmarks: QoS 0/1, no retained messages or sessions"""
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.received = 0
+        self._clients = {}  # writer -> [subscription patterns]
+        self._sessions = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        for session in self._sessions:
+            session.cancel()
+        await asyncio.gather(*self._sessions, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self._clients[writer] = []
+        self._sessions.add(asyncio.current_task())
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(encode_packet(CONNACK, 0, bytes([0, 0])))
+                elif packet_type == PUBLISH:
+                    message, packet_id = decode_publish(flags, body)
+                    self.received += 1
+                    if message.qos:
+                        writer.write(encode_packet(PUBACK, 0, struct.pack('!H', packet_id)))
+                    self.route(message)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, = struct.unpack_from('!H', body)
+                    offset = 2
+                    codes = bytearray()
+                    while offset < len(body):
+                        topic, offset = decode_string(body, offset)
+                        self._clients[writer].append(topic)
+                        codes.append(min(body[offset], 1))
+                        offset += 1
+                    writer.write(encode_packet(SUBACK, 0, struct.pack('!H', packet_id) + bytes(codes)))
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass  # client gone or broker stopping
+        finally:
+            self._clients.pop(writer, None)
+            self._sessions.discard(asyncio.current_task())
+            writer.close()
+
+    def route(self, message):
+        """Delivers a message to every matching subscriber at QoS 0"""
+        data = None
+        for writer, patterns in self._clients.items():
+            if any(topic_matches(pattern, message.topic) for pattern in patterns):
+                if data is None:
+                    data = encode_publish(message.topic, message.payload)
+                writer.write(data)
@@ -1,117 +1,131 @@
 #!/usr/bin/env python
 
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-import argparse
 import time
-import platform
-from iot import topic_parser, iot_thing_topic, iot_payload, AllowedActions, LOG_FORMAT
+import iot
+from iot import Router, iot_thing_topic, iot_payload
 import supervised
-import logging
-
-def publish(key, value, state='reported', qos=0):
-    myAWSIoTMQTTClient.publish(
-        iot_thing_topic(args.thingName),
-        iot_payload(state, {key: value}), qos)
-
-
-def subscriptionCallback(client, userdata, message):
-    global countdown
-    params = topic_parser(args.topic, message.topic)
-    if params[0] == 'start' and len(params) == 1 and supervisor.status() == 'STOPPED':
-        supervisor.start()
-    elif params[0] == 'stop' and len(params) == 1 and supervisor.status() == 'RUNNING':
-        supervisor.stop()
-    elif params[0] == 'pulse' and len(params) == 2:
-        if supervisor.status() == 'STOPPED':
-            supervisor.start()
-        if params[1].isdigit() and countdown < int(params[1]):
-            countdown = int(params[1])
+from scheduler import Scheduler
+
+class VStream:
+
+    def __init__(self, client, supervisor, thing, topic, scheduler=None):
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.supervisor = supervisor
+        self.thing = thing
+        self.topic = topic
+        self.state = supervisor.status()
+        self.router = Router(topic)
+        self.router.add('start', self.start)
+        self.router.add('stop', self.stop)
+        self.router.add('pulse/+', self.pulse, int)
+
+    def publish(self, key, value, state='reported', qos=0):
+        self.client.publish(
+            iot_thing_topic(self.thing),
+            iot_payload(state, {key: value}), qos)
+
+    def start(self):
+        if self.supervisor.status() == 'STOPPED':
+            self.supervisor.start()
+
+    def stop(self):
+        if self.supervisor.status() == 'RUNNING':
+            self.supervisor.stop()
+
+    def pulse(self, seconds):
+        self.start()
+        self.scheduler.extend(self.supervisor.process, seconds, self.supervisor.stop)
+
+    def execute(self, item):
+        """Runs one command of a batch, {"command": "pulse/60"}"""
+        if not self.router.dispatch('{}/{}'.format(self.topic, item['command'])):
+            raise ValueError('unknown command')
+
+    def subscriptionCallback(self, client, userdata, message):
+        self.router.dispatch(message.topic, message.payload)
+
+    def check(self):
+        """Publishes the service state if it changed"""
+        current_state = self.supervisor.status()
+        if self.state != current_state:  # change detected
+            self.state = current_state
+            self.publish(self.supervisor.process, current_state)
+
+    def event(self, event):
+        """Publishes a state change forwarded by stateListener.py"""
+        if self.supervisor.process not in (event['process'], '{}:{}'.format(event['group'], event['process'])):
+            return
+        self.supervisor.supervisor.invalidate()
+        if self.state != event['state']:
+            self.state = event['state']
+            self.publish(self.supervisor.process, event['state'])
 
 
 if __name__ == "__main__":
     # Read in command-line parameters
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
-                        help="Your AWS IoT custom endpoint")
-    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-    parser.add_argument("-p", "--port", action="store", dest="port", type=int, help="Port number override")
-    parser.add_argument("-w", "--websocket", action="store_true", dest="useWebsocket", default=False,
-                        help="Use MQTT over WebSocket")
-    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="",
-                        help="Targeted client id")
-    parser.add_argument("-m", "--mode", action="store", dest="mode", default="both",
-                        help="Operation modes: %s" % str(AllowedActions))
-    parser.add_argument("-t", "--topic", action="store", dest="topic", default="sdk/test/Python", help="Targeted topic")
-    parser.add_argument("-s", "--service", action="store", dest="service", default="vstream", help="Service name")
-    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default=platform.node().split('.')[0],
-                        help="Targeted thing name")
+    parser = iot.argument_parser()
+    parser.add_argument("-s", "--service", action="append", dest="service",
+                        help="Service name, repeat for several services commanded on <topic>/<service>/... " +
+                             "(default vstream)")
+    parser.add_argument("--supervisor", action="store", dest="supervisor", default=supervised.DEFAULT_PROXY,
+                        help="Supervisor XML-RPC url")
+    parser.add_argument("--rpc_timeout", help="Supervisor XML-RPC timeout in seconds", type=float, default=5)
+    parser.add_argument("--status_ttl", help="Seconds a supervisor status is cached", type=float, default=1)
+    parser.add_argument("--events", action="store", dest="events",
+                        help="Unix socket receiving state changes from stateListener.py instead of polling")
+    parser.add_argument("--poll", help="Seconds between state polls without --events", type=float, default=20)
     args = parser.parse_args()
+    iot.validate_args(parser, args)
 
-    if args.mode not in AllowedActions:
-        parser.error("Unknown --mode option %s. Must be one of %s" % (args.mode, str(AllowedActions)))
-        exit(2)
+    # Configure logging
+    iot.start_logging(args)
 
-    if args.useWebsocket and args.certificatePath and args.privateKeyPath:
-        parser.error("X.509 cert authentication and WebSocket are mutual exclusive. Please pick one.")
-        exit(2)
+    if not args.service:
+        args.service = ['vstream']
 
-    if not args.useWebsocket and (not args.certificatePath or not args.privateKeyPath):
-        parser.error("Missing credentials for authentication.")
-        exit(2)
+    # supervisor rpc, one connection and one pulse scheduler for all services
+    supervisor = supervised.Supervisor(args.supervisor, args.rpc_timeout, args.status_ttl)
+    scheduler = Scheduler()
 
-    # Port defaults
-    port = args.port
-    if args.useWebsocket and not args.port:  # When no port override for WebSocket, default to 443
-        port = 443
-    if not args.useWebsocket and not args.port:  # When no port override for non-WebSocket, default to 8883
-        port = 8883
+    myAWSIoTMQTTClient = iot.connect_from_args(args, connect=False)
 
-    # Configure logging
-    logging.basicConfig(level=logging.WARN, format=LOG_FORMAT)
-
-    # supervisor rpc
-    supervisor = supervised.Supervised(args.service)
-    state = supervisor.status()
-    countdown = 0
-
-    # Init AWSIoTMQTTClient
-    myAWSIoTMQTTClient = None
-    if args.useWebsocket:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId, useWebsocket=True)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath)
-    else:
-        myAWSIoTMQTTClient = AWSIoTMQTTClient(args.clientId)
-        myAWSIoTMQTTClient.configureEndpoint(args.host, port)
-        myAWSIoTMQTTClient.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
+    # a single service keeps its commands directly under the topic
+    handlers = []
+    targets = {}  # batch target (service name) -> handler
+    for service in args.service:
+        topic = args.topic if len(args.service) == 1 else '{}/{}'.format(args.topic, service)
+        handlers.append(VStream(myAWSIoTMQTTClient, supervised.Supervised(service, supervisor=supervisor),
+                                args.thingName, topic, scheduler))
+        targets[service] = handlers[-1]
 
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
+    # <topic>/batch carries commands for many services in one message
+    batch = iot.Batch(myAWSIoTMQTTClient, args.topic, targets)
+    if len(handlers) == 1:
+        handlers[0].router.add('batch', batch.execute, payload=True)
 
     # Connect and subscribe to AWS IoT
-    myAWSIoTMQTTClient.connect()
+    with iot.profile('connect'):
+        myAWSIoTMQTTClient.connect()
     if args.mode == 'both' or args.mode == 'subscribe':
-        myAWSIoTMQTTClient.subscribe('{}/#'.format(args.topic), 1, subscriptionCallback)
+        for handler in handlers:
+            myAWSIoTMQTTClient.subscribe('{}/#'.format(handler.topic), 1, handler.subscriptionCallback)
+        if len(handlers) > 1:
+            myAWSIoTMQTTClient.subscribe(batch.topic, 1, batch.subscriptionCallback)
         time.sleep(2)  # give service time to subscribe
+    iot.start_metrics(args, myAWSIoTMQTTClient)
 
-    count = 0
-    while True:
-        count += 1
-        time.sleep(1)
-        if countdown == 1:
-            supervisor.stop()
-            countdown = 0
-        else:
-            countdown -= 1
-        if count % 20 == 0:
-            count = 0  # reset
-            current_state = supervisor.status()
-            if state != current_state:  # change detected
-                state = current_state
-                publish(supervisor.process, current_state)
+    if args.profile_startup:
+        iot.report_startup()
+
+    for handler in handlers:
+        handler.check()
+    if args.events:
+        for event in supervised.state_events(args.events):
+            for handler in handlers:
+                handler.event(event)
+    else:
+        while True:
+            time.sleep(args.poll)
+            for handler in handlers:
+                handler.check()